@@ -0,0 +1,270 @@
+# ------------------ Pipeline Benchmark ------------------
+
+import argparse
+import contextlib
+import importlib
+import json
+import logging
+import os
+import re
+import resource
+import sys
+import tempfile
+import time
+import tracemalloc
+from datetime import datetime
+from dateutil import parser as dateutil_parser
+
+from synthetic_data import generate_dataset
+from local_endpoints import SparqlStandIn, GeoNamesStub, WikidataStub
+from graph_store import LocalGraphStore
+import date_parsing
+from metrics import metrics
+
+STAGES = ["dates", "enrich_places", "match_places", "enrich_persons", "match_persons", "match_earthquakes"]
+
+def max_rss_mb():
+    """Peak resident set size of this process (and of reaped worker processes) in MiB."""
+    own = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    children = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    scale = 1 if sys.platform == "darwin" else 1024  # ru_maxrss is in bytes on macOS, KiB elsewhere
+    return round(max(own, children) * scale / 2 ** 20, 1)
+
+def request_counts(servers):
+    """Flattened request counters of the stand-ins, e.g. {"sparql.query": 12, "geonames.searchJSON": 40}."""
+    return {f"{name}.{kind}": count for name, server in servers.items() for kind, count in server.requests.items()}
+
+def pipeline_stages(args):
+    """
+    The steps of instance_matching.main as (name, callable) pairs. The pipeline modules are imported
+    here, after the environment points config at the stand-ins.
+    """
+    match_eq = importlib.import_module("match_eq")
+    match_places = importlib.import_module("match_places")
+    person_match = importlib.import_module("person_match")
+    return {
+        "dates": match_eq.normalize_dates,
+        "enrich_places": lambda: match_places.enrich_places(False),
+        "match_places": lambda: match_places.match_places(workers=args.workers, link_mode=args.links),
+        "enrich_persons": lambda: person_match.enrich_persons(False),
+        "match_persons": lambda: person_match.match_persons(workers=args.workers, link_mode=args.links),
+        "match_earthquakes": lambda: match_eq.match_earthquakes(workers=args.workers, link_mode=args.links),
+    }
+
+def run_stage(name, stage, servers, trace_memory):
+    """
+    Run one stage and measure it: wall time, pairs compared (for the matchers) and pairs/sec,
+    requests issued to each stand-in, Python heap peak (tracemalloc), process peak RSS and
+    the pipeline's own counters and request latencies (metrics.py).
+    """
+    before = request_counts(servers)
+    if trace_memory:
+        tracemalloc.reset_peak()
+    metrics.reset()
+    start = time.perf_counter()
+    result = stage()
+    seconds = time.perf_counter() - start
+    after = request_counts(servers)
+    pairs = result if isinstance(result, int) else None
+    stage_metrics = metrics.snapshot()
+    return {
+        "stage": name,
+        "seconds": round(seconds, 4),
+        "pairs": pairs,
+        "pairs_per_sec": round(pairs / seconds, 1) if pairs is not None and seconds > 0 else None,
+        "http_requests": {kind: after[kind] - before.get(kind, 0) for kind in after if after[kind] != before.get(kind, 0)},
+        "peak_memory_mb": round(tracemalloc.get_traced_memory()[1] / 2 ** 20, 1) if trace_memory else None,
+        "max_rss_mb": max_rss_mb(),
+        "counters": stage_metrics["counters"],
+        "latency": stage_metrics["latency"],
+    }
+
+def run_concurrent(args, stages):
+    """
+    Run the selected stages together on utils.run_stages with the dependencies of instance_matching.main.
+    Stages overlap, so only the timeline and the run's counters and latencies are reported, not per-stage figures.
+    """
+    run_stages = importlib.import_module("utils").run_stages
+    dependencies = importlib.import_module("instance_matching").STAGE_DEPENDENCIES
+    pipeline_name = {"dates": "normalize_dates"}
+    metrics.reset()
+    run_stages({pipeline_name.get(name, name): (stages[name], dependencies[pipeline_name.get(name, name)])
+                for name in STAGES if name in args.stages}, args.stage_workers)
+    run_metrics = metrics.snapshot()
+    return {"timeline": run_metrics["timeline"], "counters": run_metrics["counters"], "latency": run_metrics["latency"]}
+
+# ------------------ Date Parsing Micro-benchmark ------------------
+
+def legacy_normalize_date_string(value):
+    """normalize_date_string as it was before date_parsing.py: dateutil first, then the patterns."""
+    try:
+        return dateutil_parser.parse(value).isoformat()
+    except ValueError:
+        if re.match(r"^\d{4}$", value):
+            return f"{value}-01-01T00:00:00"
+        elif re.match(r"^\d{4}-\d{2}$", value):
+            return f"{value}-01T00:00:00"
+        elif re.match(r"^\d{4}-\d{2}-\d{2}$", value):
+            return f"{value}T00:00:00"
+        elif "circa" in value.lower() or "c." in value.lower():
+            match = re.search(r"(\d{4})", value)
+            if match:
+                return f"{match.group(1)}-01-01T00:00:00"
+        elif re.match(r"^\d{4}-\d{4}$", value):
+            years = value.split('-')
+            return f"{years[0]}-01-01T00:00:00/{years[1]}-12-31T23:59:59"
+    return None
+
+def legacy_extract_datetime(date_string):
+    """extract_datetime as it was before date_parsing.py."""
+    if '#' in date_string:
+        date_string = date_string.split('#')[-1]
+    match = re.search(r'^(\d{4}-\d{2}-\d{2}_\d{2}:\d{2})', date_string)
+    if match:
+        try:
+            return datetime.strptime(match.group(1), "%Y-%m-%d_%H:%M")
+        except ValueError:
+            return None
+    return None
+
+def legacy_extract_year(date_string):
+    """extract_year as it was before date_parsing.py."""
+    match = re.search(r'(\d{4})', date_string)
+    return int(match.group(1)) if match else None
+
+def date_samples(n):
+    """n distinct date literals in the formats of the data, cycling through them."""
+    formats = [
+        lambda y, k: f"{y}",
+        lambda y, k: f"{y}-{k % 12 + 1:02d}",
+        lambda y, k: f"{y}-{k % 12 + 1:02d}-{k % 28 + 1:02d}",
+        lambda y, k: f"{y}-{k % 12 + 1:02d}-{k % 28 + 1:02d}_{k % 24:02d}:{k % 60:02d}",
+        lambda y, k: f"https://crm-eq.ics.forth.gr/data/timespan#{y}-{k % 12 + 1:02d}-{k % 28 + 1:02d}_{k % 24:02d}:00",
+        lambda y, k: f"circa {y}",
+        lambda y, k: f"{y}-{y + k % 9 + 1}",
+        lambda y, k: f"{k % 28 + 1} March {y}",
+    ]
+    return [formats[k % len(formats)](1000 + k // len(formats) % 999, k) for k in range(n)]
+
+def time_calls(function, values):
+    start = time.perf_counter()
+    for value in values:
+        function(value)
+    return round((time.perf_counter() - start) / len(values) * 1e6, 3)
+
+def date_parsing_benchmark(n):
+    """
+    Per-call cost (microseconds) of the date functions before and after date_parsing.py on n distinct
+    literals: the legacy functions, the new ones on first sight of a literal and on repeated literals
+    (memoized), and how many legacy results differ.
+    """
+    values = date_samples(n)
+    for function in (date_parsing.parse_iso, date_parsing.parse_date, date_parsing.extract_year):
+        function.cache_clear()
+    report = {"literals": n, "microseconds_per_call": {}}
+    timings = report["microseconds_per_call"]
+    timings["normalize_date_string"] = {
+        "legacy": time_calls(legacy_normalize_date_string, values),
+        "first_call": time_calls(date_parsing.normalize_date_string, values),
+        "memoized": time_calls(date_parsing.normalize_date_string, values),
+    }
+    date_parsing.parse_iso.cache_clear()
+    timings["extract_datetime"] = {
+        "legacy": time_calls(legacy_extract_datetime, values),
+        "first_call": time_calls(date_parsing.extract_datetime, values),
+        "memoized": time_calls(date_parsing.extract_datetime, values),
+    }
+    timings["extract_year"] = {
+        "legacy": time_calls(legacy_extract_year, values),
+        "first_call": time_calls(date_parsing.extract_year, values),
+        "memoized": time_calls(date_parsing.extract_year, values),
+    }
+    report["differences"] = {
+        "normalize_date_string": sum(legacy_normalize_date_string(v) != date_parsing.normalize_date_string(v) for v in values),
+        "extract_datetime": sum(legacy_extract_datetime(v) != date_parsing.extract_datetime(v) for v in values),
+        "extract_year": sum(legacy_extract_year(v) != date_parsing.extract_year(v) for v in values),
+    }
+    return report
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the instance matching pipeline on synthetic data "
+                                                 "against local SPARQL, GeoNames and Wikidata stand-ins.")
+    parser.add_argument("--places", type=int, default=500)
+    parser.add_argument("--persons", type=int, default=500)
+    parser.add_argument("--earthquakes", type=int, default=500)
+    parser.add_argument("--dup-rate", type=float, default=0.1, help="Share of records that duplicate an earlier one.")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--stages", nargs="+", choices=STAGES, default=STAGES, help="Stages to run, in pipeline order.")
+    parser.add_argument("--workers", type=int, default=1, help="Processes scoring candidate pairs.")
+    parser.add_argument("--links", default="clique", help="sameAs link mode of the matchers.")
+    parser.add_argument("--stage-workers", type=int, default=1,
+                        help="Run the stages concurrently on the pipeline's stage scheduler (1 = one after the other, measured per stage).")
+    parser.add_argument("--backend", choices=["http", "local"], default="http",
+                        help="Reach the data through the SPARQL stand-in (http) or the in-process local graph store (local).")
+    parser.add_argument("--latency", type=float, default=0.0, help="Seconds added to every stand-in response.")
+    parser.add_argument("--no-tracemalloc", action="store_true", help="Skip Python heap tracing (it slows the stages down).")
+    parser.add_argument("--log-level", default="WARNING", choices=["DEBUG", "INFO", "WARNING", "ERROR"],
+                        help="Log level of the pipeline's own output.")
+    parser.add_argument("--date-parsing", type=int, metavar="N",
+                        help="Only run the date parsing micro-benchmark on N distinct literals.")
+    parser.add_argument("--output", help="Write the JSON report here instead of stdout.")
+    args = parser.parse_args()
+    if args.date_parsing:
+        write_report(date_parsing_benchmark(args.date_parsing), args.output)
+        return
+    logging.basicConfig(level=args.log_level, format="%(message)s")
+    logging.getLogger("rdflib.term").setLevel(logging.ERROR)  # the stand-in stores literals as the pipeline writes them
+
+    dataset, data_stats = generate_dataset(args.places, args.persons, args.earthquakes, args.dup_rate, args.seed)
+    servers = {"sparql": SparqlStandIn(dataset, args.latency), "geonames": GeoNamesStub(args.latency),
+               "wikidata": WikidataStub(args.latency)}
+    output_path = os.path.abspath(args.output) if args.output else None
+    report = {"config": vars(args), "data": data_stats, "stages": []}
+
+    with contextlib.ExitStack() as stack:
+        for server in servers.values():
+            stack.enter_context(server)
+        os.environ.update({
+            "SPARQL_ENDPOINT": servers["sparql"].endpoint,
+            "GEONAMES_API_URL": servers["geonames"].url,
+            "WIKIDATA_ENDPOINT": servers["wikidata"].url,
+            "GEONAMES_USERNAME": "benchmark",
+            "GEONAMES_RATE_PER_HOUR": "0",
+            "GEONAMES_INDEX": "",
+            "WIKIDATA_INDEX": "",
+        })
+        stages = pipeline_stages(args)
+        if args.backend == "local":
+            importlib.import_module("config").use_local_graph(LocalGraphStore(dataset))
+        # Caches and snapshots are created in the working directory; keep them out of the real ones.
+        workdir = stack.enter_context(tempfile.TemporaryDirectory(prefix="im-bench-"))
+        stack.callback(os.chdir, os.getcwd())
+        os.chdir(workdir)
+        if not args.no_tracemalloc:
+            tracemalloc.start()
+        total = time.perf_counter()
+        if args.stage_workers > 1:
+            report.update(run_concurrent(args, stages))
+        else:
+            for name in STAGES:
+                if name in args.stages:
+                    report["stages"].append(run_stage(name, stages[name], servers, not args.no_tracemalloc))
+        report["total_seconds"] = round(time.perf_counter() - total, 4)
+        report["http_requests"] = request_counts(servers)
+        report["triples_after"] = len(dataset)
+        if not args.no_tracemalloc:
+            tracemalloc.stop()
+
+    write_report(report, output_path)
+
+def write_report(report, output_path=None):
+    text = json.dumps(report, indent=2)
+    if output_path:
+        with open(output_path, "w", encoding="utf-8") as f:
+            f.write(text + "\n")
+    else:
+        print(text)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,93 @@
+# ------------------ Persistent Key/Value Cache ------------------
+
+import argparse
+import json
+import os
+import sqlite3
+import threading
+import time
+
+
+class SQLiteCache:
+    """
+    Persistent key/value cache backed by a SQLite table.
+    Values are stored as JSON; lookups and inserts are keyed by the primary index,
+    and every insert is committed on its own, so a crash mid-run loses at most
+    the entry being written. The connection is shared between threads behind a lock.
+    With a ttl (in seconds), entries older than ttl are treated as missing.
+    """
+
+    def __init__(self, path, table="cache", ttl=None):
+        self.path = path
+        self.table = table
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute(f'CREATE TABLE IF NOT EXISTS "{table}" '
+                                f'(key TEXT PRIMARY KEY, value TEXT NOT NULL, stored_at REAL)')
+        columns = {row[1] for row in self.connection.execute(f'PRAGMA table_info("{table}")')}
+        if "stored_at" not in columns:
+            self.connection.execute(f'ALTER TABLE "{table}" ADD COLUMN stored_at REAL')
+        self.connection.commit()
+
+    def get(self, key):
+        with self.lock:
+            row = self.connection.execute(f'SELECT value, stored_at FROM "{self.table}" WHERE key = ?',
+                                          (key,)).fetchone()
+        if not row:
+            return None
+        if self.ttl and (row[1] is None or time.time() - row[1] > self.ttl):
+            return None
+        return json.loads(row[0])
+
+    def put(self, key, value):
+        with self.lock, self.connection:
+            self.connection.execute(f'INSERT OR REPLACE INTO "{self.table}" (key, value, stored_at) VALUES (?, ?, ?)',
+                                    (key, json.dumps(value), time.time()))
+
+    def put_many(self, entries, replace=False):
+        """Insert many (key, value) pairs in a single transaction; with replace, drop every other entry."""
+        with self.lock, self.connection:
+            now = time.time()
+            if replace:
+                self.connection.execute(f'DELETE FROM "{self.table}"')
+            self.connection.executemany(f'INSERT OR REPLACE INTO "{self.table}" (key, value, stored_at) VALUES (?, ?, ?)',
+                                        ((key, json.dumps(value), now) for key, value in entries))
+
+    def items(self):
+        """Return every (key, value) pair in the cache, ignoring the ttl."""
+        with self.lock:
+            rows = self.connection.execute(f'SELECT key, value FROM "{self.table}"').fetchall()
+        return [(key, json.loads(value)) for key, value in rows]
+
+    def __len__(self):
+        with self.lock:
+            return self.connection.execute(f'SELECT COUNT(*) FROM "{self.table}"').fetchone()[0]
+
+    def import_json(self, json_path):
+        """Import every entry of a whole-file JSON cache ({key: value}); returns the number imported."""
+        with open(json_path, "r", encoding="utf-8") as f:
+            entries = json.load(f)
+        with self.lock, self.connection:
+            now = time.time()
+            self.connection.executemany(f'INSERT OR REPLACE INTO "{self.table}" (key, value, stored_at) VALUES (?, ?, ?)',
+                                        ((key, json.dumps(value), now) for key, value in entries.items()))
+        return len(entries)
+
+    def close(self):
+        self.connection.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Import a whole-file JSON cache into a SQLite cache.")
+    parser.add_argument("json_path", help="Existing JSON cache, e.g. geonames_cache.json.")
+    parser.add_argument("db_path", help="SQLite cache file, e.g. geonames_cache.sqlite.")
+    parser.add_argument("--table", default="geonames", help="Cache table to import into.")
+    args = parser.parse_args()
+
+    if not os.path.exists(args.json_path):
+        parser.error(f"{args.json_path} does not exist")
+    cache = SQLiteCache(args.db_path, args.table)
+    print(f"Imported {cache.import_json(args.json_path)} entries into {args.db_path} ({args.table}).")
+    cache.close()
@@ -1,16 +1,98 @@
 from rdflib import Namespace
 import os
-from SPARQLWrapper import SPARQLWrapper, JSON, POST, URLENCODED
 from dotenv import load_dotenv
+from metrics import metrics
+from sparql_client import SparqlEndpoint, insert_data_query
 EARTHQUAKE_MODEL = Namespace("https://crm-eq.ics.forth.gr/ontology#")
 load_dotenv()
 
 GEONAMES_USERNAME = os.getenv("GEONAMES_USERNAME", "sophisid")
+# Several GeoNames accounts may be given as a comma-separated list; the first one is GEONAMES_USERNAME.
+GEONAMES_USERNAMES = [name.strip() for name in GEONAMES_USERNAME.split(",") if name.strip()]
+GEONAMES_USERNAME = GEONAMES_USERNAMES[0] if GEONAMES_USERNAMES else GEONAMES_USERNAME
+GEONAMES_API_URL = os.getenv("GEONAMES_API_URL", "http://api.geonames.org")
+GEONAMES_WORKERS = int(os.getenv("GEONAMES_WORKERS", "4"))  # concurrent GeoNames lookups
+GEONAMES_RATE_PER_HOUR = float(os.getenv("GEONAMES_RATE_PER_HOUR", "0"))  # requests per account per hour (0 = no limit)
+GEONAMES_INDEX = os.getenv("GEONAMES_INDEX", "")  # offline GeoNames index directory (empty = use the web services)
 SPARQL_ENDPOINT = os.getenv("SPARQL_ENDPOINT", "http://localhost:8898/sparql")
+SPARQL_UPDATE_ENDPOINT = os.getenv("SPARQL_UPDATE_ENDPOINT", SPARQL_ENDPOINT)  # endpoint updates are sent to
+SPARQL_POOL_SIZE = int(os.getenv("SPARQL_POOL_SIZE", "8"))  # keep-alive connections of the read and of the write pool
+SPARQL_RETRIES = int(os.getenv("SPARQL_RETRIES", "3"))  # retries of a failed SPARQL request
+SPARQL_BACKOFF = float(os.getenv("SPARQL_BACKOFF", "0.5"))  # seconds before the first retry, doubled for each next one
+SPARQL_TIMEOUT = float(os.getenv("SPARQL_TIMEOUT", "300"))  # seconds to wait for a SPARQL response
 USERNAME = os.getenv("USERNAME", "dba")
 PASSWORD = os.getenv("PASSWORD", "dba")
+WIKIDATA_ENDPOINT = os.getenv("WIKIDATA_ENDPOINT", "https://query.wikidata.org/sparql")
+WIKIDATA_CACHE_TTL_DAYS = float(os.getenv("WIKIDATA_CACHE_TTL_DAYS", "0"))  # 0 keeps cached results forever
+WIKIDATA_BATCH_SIZE = int(os.getenv("WIKIDATA_BATCH_SIZE", "50"))  # names per VALUES query
+WIKIDATA_CONCURRENCY = int(os.getenv("WIKIDATA_CONCURRENCY", "4"))  # Wikidata batches fetched concurrently
+WIKIDATA_TIMEOUT = float(os.getenv("WIKIDATA_TIMEOUT", "60"))  # seconds to wait for a Wikidata response
+WIKIDATA_INDEX = os.getenv("WIKIDATA_INDEX", "")  # offline Wikidata index file (empty = use the query service)
+PAGE_SIZE = int(os.getenv("PAGE_SIZE", "10000"))  # rows per page when reading entities from the endpoint
+LINK_BATCH_SIZE = int(os.getenv("LINK_BATCH_SIZE", "500"))  # link triples per INSERT DATA request
+DATE_BATCH_SIZE = int(os.getenv("DATE_BATCH_SIZE", "200"))  # date rewrites per DELETE/INSERT request
+MATCH_WORKERS = int(os.getenv("MATCH_WORKERS", "1"))  # processes scoring candidate pairs (1 = serial)
+PAIRS_PER_TASK = int(os.getenv("PAIRS_PER_TASK", "20000"))  # candidate pairs per process-pool task
+STAGE_WORKERS = int(os.getenv("STAGE_WORKERS", "4"))  # pipeline stages run concurrently (1 = one after the other)
+# Local RDF dumps (comma-separated) to run against instead of SPARQL_ENDPOINT, see graph_store.py.
+LOCAL_GRAPH = [path.strip() for path in os.getenv("LOCAL_GRAPH", "").split(",") if path.strip()]
+LOCAL_GRAPH_STORE = os.getenv("LOCAL_GRAPH_STORE", "Memory")  # rdflib store plugin; others are opened at LOCAL_GRAPH_DB
+LOCAL_GRAPH_DB = os.getenv("LOCAL_GRAPH_DB", "local_graph_db")
+LOCAL_GRAPH_OUTPUT = os.getenv("LOCAL_GRAPH_OUTPUT", "links.nq")  # links and enrichment of a local run are written here
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO")  # DEBUG also logs every match decision and service call
+METRICS_OUTPUT = os.getenv("METRICS_OUTPUT", "metrics.json")  # JSON metrics dump written at the end of a run
 
-sparql = SPARQLWrapper(SPARQL_ENDPOINT)
-sparql.setReturnFormat(JSON)
-sparql.setCredentials(USERNAME, PASSWORD)
-sparql.setRequestMethod(URLENCODED)
\ No newline at end of file
+local_store = None  # LocalGraphStore the pipeline runs against, set by use_local_graph
+
+class SparqlClient:
+    """
+    SPARQL client the modules share as `sparql`. select(query) returns the SPARQL JSON results from
+    the reader and update(query) runs on the writer; both are stateless, so threads can share the
+    client. The reader and writer are pooled SparqlEndpoints (SPARQL_ENDPOINT / SPARQL_UPDATE_ENDPOINT),
+    or the same graph_store.LocalGraphStore after use_local_graph. Requests are counted and timed as
+    "sparql" and "sparql_update". insert(graph, triples) adds N-Triples lines to a named graph; after
+    use_export, inserts and updates go to a link_export.TripleExport and nothing is written to the endpoint.
+    """
+
+    def __init__(self, reader, writer):
+        self.reader = reader
+        self.writer = writer
+        self.exporter = None
+
+    def select(self, query):
+        with metrics.request("sparql"):
+            return self.reader.select(query)
+
+    def update(self, query):
+        if self.exporter is not None:
+            self.exporter.update(query)
+            return
+        with metrics.request("sparql_update"):
+            self.writer.update(query)
+
+    def insert(self, graph, triples):
+        if self.exporter is not None:
+            self.exporter.write(graph, triples)
+            return
+        self.update(insert_data_query(graph, triples))
+
+def endpoint(url):
+    return SparqlEndpoint(url, USERNAME, PASSWORD, SPARQL_POOL_SIZE, SPARQL_RETRIES, SPARQL_BACKOFF, SPARQL_TIMEOUT)
+
+def create_sparql():
+    """Create a SPARQL client with read and write pools of its own (or on the local graph after use_local_graph)."""
+    if local_store is not None:
+        return SparqlClient(local_store, local_store)
+    return SparqlClient(endpoint(SPARQL_ENDPOINT), endpoint(SPARQL_UPDATE_ENDPOINT))
+
+def use_local_graph(store):
+    """Run all SPARQL queries and updates against a graph_store.LocalGraphStore instead of the endpoint."""
+    global local_store
+    local_store = store
+    sparql.reader = sparql.writer = store
+
+def use_export(exporter):
+    """Send all writes to a link_export.TripleExport instead of the endpoint; reads still use it."""
+    sparql.exporter = exporter
+
+sparql = create_sparql()
@@ -0,0 +1,128 @@
+# ------------------ Historical Date Parsing ------------------
+
+import calendar
+import re
+from datetime import datetime
+from functools import lru_cache
+from dateutil import parser
+
+YEAR = re.compile(r"^(\d{4})$")
+YEAR_MONTH = re.compile(r"^(\d{4})-(\d{2})$")
+DATE = re.compile(r"^(\d{4})-(\d{2})-(\d{2})$")
+DATETIME_IRI = re.compile(r"^(\d{4})-(\d{2})-(\d{2})_(\d{2}):(\d{2})")  # prefix of e.g. ...#1750-03-12_10:30
+DATETIME_ISO = re.compile(r"^(\d{4})-(\d{2})-(\d{2})T(\d{2}):(\d{2})(?::(\d{2}))?$")
+YEAR_RANGE = re.compile(r"^(\d{4})-(\d{4})$")
+CIRCA = re.compile(r"circa|c\.", re.IGNORECASE)
+FIRST_YEAR = re.compile(r"(\d{4})")
+YEAR_TOKEN = re.compile(r"\b\d{3,4}\b")
+PARSE_DEFAULT = datetime(1, 1, 1)  # dateutil fills missing fields from here, not from today's date
+
+class DateInterval:
+    """
+    A parsed date literal: the first and last instant it covers and its precision ("year", "month",
+    "day", "minute" for YYYY-MM-DD_HH:MM, "second" for ISO times and dateutil results, or "range"
+    for YYYY-YYYY). approximate is set for circa dates.
+    """
+
+    def __init__(self, start, end, precision, approximate=False):
+        self.start = start
+        self.end = end
+        self.precision = precision
+        self.approximate = approximate
+
+    def isoformat(self):
+        """The xsd:dateTime value normalize_dates writes: the start, or start/end for a range."""
+        if self.precision == "range":
+            return f"{self.start.isoformat()}/{self.end.isoformat()}"
+        return self.start.isoformat()
+
+    def __repr__(self):
+        return f"DateInterval({self.start.isoformat()}, {self.end.isoformat()}, {self.precision!r})"
+
+def year_interval(year, precision="year", approximate=False):
+    return DateInterval(datetime(year, 1, 1), datetime(year, 12, 31, 23, 59, 59), precision, approximate)
+
+def _fast_interval(value):
+    """The interval of one of the formats seen in the data, or None; raises ValueError for impossible dates."""
+    match = YEAR.match(value)
+    if match:
+        return year_interval(int(match.group(1)))
+    match = YEAR_MONTH.match(value)
+    if match:
+        year, month = int(match.group(1)), int(match.group(2))
+        last_day = calendar.monthrange(year, month)[1]
+        return DateInterval(datetime(year, month, 1), datetime(year, month, last_day, 23, 59, 59), "month")
+    match = DATE.match(value)
+    if match:
+        start = datetime(*map(int, match.groups()))
+        return DateInterval(start, start.replace(hour=23, minute=59, second=59), "day")
+    match = DATETIME_IRI.match(value)
+    if match:
+        start = datetime(*map(int, match.groups()))
+        return DateInterval(start, start.replace(second=59), "minute")
+    match = DATETIME_ISO.match(value)
+    if match:
+        start = datetime(*(int(group or 0) for group in match.groups()))
+        return DateInterval(start, start, "second")
+    match = YEAR_RANGE.match(value)
+    if match:
+        return DateInterval(datetime(int(match.group(1)), 1, 1), datetime(int(match.group(2)), 12, 31, 23, 59, 59), "range")
+    return None
+
+@lru_cache(maxsize=None)
+def parse_iso(value):
+    """
+    Parse the formats seen in the data with precompiled patterns only: YYYY, YYYY-MM, YYYY-MM-DD,
+    YYYY-MM-DD_HH:MM (also as the fragment of an IRI), YYYY-MM-DDTHH:MM[:SS] and YYYY-YYYY.
+    Returns a DateInterval, or None.
+    """
+    value = value.strip()
+    if "#" in value:
+        value = value.rsplit("#", 1)[-1]
+    try:
+        return _fast_interval(value)
+    except ValueError:
+        return None
+
+@lru_cache(maxsize=None)
+def parse_date(value):
+    """
+    Parse a historical date literal into a DateInterval, or None. The fast patterns of parse_iso are
+    tried first; other strings go to dateutil (missing month or day default to January 1st, not to
+    today's date), whose result is only kept when its year is written in the string, so "10" is not
+    read as 0001-01-10. A "circa"/"c." string with a year is taken as that (approximate) year.
+    """
+    interval = parse_iso(value)
+    if interval is not None:
+        return interval
+    try:
+        start = parser.parse(value, default=PARSE_DEFAULT)
+        if start.year in {int(year) for year in YEAR_TOKEN.findall(value)}:
+            return DateInterval(start, start, "second")
+    except (ValueError, OverflowError):
+        pass
+    if CIRCA.search(value):
+        match = FIRST_YEAR.search(value)
+        if match and int(match.group(1)) > 0:
+            return year_interval(int(match.group(1)), approximate=True)
+    return None
+
+def normalize_date_string(value):
+    """Normalize a date literal to ISO 8601 (xsd:dateTime), or None when it cannot be parsed."""
+    interval = parse_date(value)
+    return interval.isoformat() if interval is not None else None
+
+@lru_cache(maxsize=None)
+def extract_year(date_string):
+    """The first four-digit number of the string, as an int, or None."""
+    match = FIRST_YEAR.search(date_string)
+    if match:
+        return int(match.group(1))
+    return None
+
+def extract_datetime(date_string):
+    """The datetime of a YYYY-MM-DD_HH:MM date (or IRI ending in one), or None for other dates."""
+    interval = parse_iso(date_string)
+    if interval is not None and interval.precision == "minute":
+        return interval.start
+    return None
@@ -0,0 +1,212 @@
+# ------------------ Offline GeoNames Index ------------------
+
+import argparse
+import math
+import os
+import sqlite3
+import threading
+import numpy as np
+from utils import KM_PER_DEGREE, haversine_one_to_many, chunked
+
+# Columns of the GeoNames dump (allCountries.txt or a country file such as GR.txt).
+GEONAMEID, NAME, ASCIINAME, ALTERNATENAMES, LATITUDE, LONGITUDE, FEATURE_CLASS, FEATURE_CODE, COUNTRY_CODE = range(9)
+ADMIN1_CODE, POPULATION = 10, 14
+
+CELL_DEG = 1                  # grid cell size (degrees) of the nearest-place arrays
+ROWS, COLS = 180 // CELL_DEG, 360 // CELL_DEG
+NEARBY_MAX_KM = 300           # findNearbyPlaceName searches no further than this
+INSERT_BATCH = 10000          # dump rows per SQLite transaction while building
+
+def name_key(name):
+    return " ".join(name.lower().split())
+
+def cell_of(lat, lon):
+    row = min(ROWS - 1, max(0, int(math.floor((lat + 90) / CELL_DEG))))
+    col = int(math.floor((lon + 180) / CELL_DEG)) % COLS
+    return row, col
+
+def read_admin1_names(path):
+    """{"GR.ESYE31": "Attica", ...} from admin1CodesASCII.txt."""
+    names = {}
+    with open(path, "r", encoding="utf-8") as f:
+        for line in f:
+            fields = line.rstrip("\n").split("\t")
+            if len(fields) >= 2:
+                names[fields[0]] = fields[1]
+    return names
+
+def read_country_names(path):
+    """{"GR": "Greece", ...} from countryInfo.txt."""
+    names = {}
+    with open(path, "r", encoding="utf-8") as f:
+        for line in f:
+            if line.startswith("#"):
+                continue
+            fields = line.rstrip("\n").split("\t")
+            if len(fields) >= 5:
+                names[fields[0]] = fields[4]
+    return names
+
+def build_index(dump_path, index_dir, admin1_path=None, countries_path=None):
+    """
+    Build an offline index from a GeoNames dump into index_dir:
+      geonames.sqlite  place details keyed by geonameId, and every name, ASCII name and
+                       alternate name (lowercased) mapped to its geonameId;
+      lat.npy/lon.npy/ids.npy/cells.npy
+                       populated places (feature class P) sorted by grid cell, with the start
+                       offset of every cell, for memory-mapped nearest-place lookups.
+    adminName1 and countryName are filled from admin1CodesASCII.txt / countryInfo.txt when given.
+    Returns the number of places indexed.
+    """
+    os.makedirs(index_dir, exist_ok=True)
+    admin1_names = read_admin1_names(admin1_path) if admin1_path else {}
+    country_names = read_country_names(countries_path) if countries_path else {}
+    db_path = os.path.join(index_dir, "geonames.sqlite")
+    if os.path.exists(db_path):
+        os.remove(db_path)
+    connection = sqlite3.connect(db_path)
+    connection.execute("CREATE TABLE places (geonameid INTEGER PRIMARY KEY, name TEXT, lat TEXT, lng TEXT, "
+                       "adminName1 TEXT, countryCode TEXT, countryName TEXT, fcl TEXT, fcode TEXT, population INTEGER)")
+    connection.execute("CREATE TABLE names (name TEXT NOT NULL, geonameid INTEGER NOT NULL)")
+
+    lats, lons, ids = [], [], []
+    count = 0
+    with open(dump_path, "r", encoding="utf-8") as f:
+        rows = (line.rstrip("\n").split("\t") for line in f)
+        for batch in chunked((fields for fields in rows if len(fields) > POPULATION), INSERT_BATCH):
+            places = []
+            names = []
+            for fields in batch:
+                geonameid = int(fields[GEONAMEID])
+                country_code = fields[COUNTRY_CODE]
+                places.append((geonameid, fields[NAME], fields[LATITUDE], fields[LONGITUDE],
+                               admin1_names.get(f"{country_code}.{fields[ADMIN1_CODE]}", ""),
+                               country_code, country_names.get(country_code, ""),
+                               fields[FEATURE_CLASS], fields[FEATURE_CODE], int(fields[POPULATION] or 0)))
+                keys = {name_key(fields[NAME]), name_key(fields[ASCIINAME])}
+                keys.update(name_key(name) for name in fields[ALTERNATENAMES].split(",") if name)
+                names.extend((key, geonameid) for key in keys if key)
+                if fields[FEATURE_CLASS] == "P":
+                    lats.append(float(fields[LATITUDE]))
+                    lons.append(float(fields[LONGITUDE]))
+                    ids.append(geonameid)
+            with connection:
+                connection.executemany("INSERT OR REPLACE INTO places VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)", places)
+                connection.executemany("INSERT INTO names VALUES (?, ?)", names)
+            count += len(places)
+    connection.execute("CREATE INDEX names_name ON names (name)")
+    connection.commit()
+    connection.close()
+
+    lats = np.array(lats, dtype=np.float64)
+    lons = np.array(lons, dtype=np.float64)
+    ids = np.array(ids, dtype=np.int64)
+    cells = np.array([row * COLS + col for row, col in map(cell_of, lats, lons)], dtype=np.int64)
+    order = np.argsort(cells, kind="stable")
+    np.save(os.path.join(index_dir, "lat.npy"), lats[order])
+    np.save(os.path.join(index_dir, "lon.npy"), lons[order])
+    np.save(os.path.join(index_dir, "ids.npy"), ids[order])
+    np.save(os.path.join(index_dir, "cells.npy"), np.searchsorted(cells[order], np.arange(ROWS * COLS + 1)))
+    return count
+
+class GeoNamesIndex:
+    """
+    Offline replacement for the findNearbyPlaceNameJSON and searchJSON services, backed by an
+    index built with build_index. The coordinate arrays are memory-mapped; the SQLite connection
+    is shared between threads behind a lock. Results have the shape of the GeoNames JSON entries
+    (geonameId, name, lat, lng, adminName1, countryName, ...).
+    """
+
+    def __init__(self, index_dir):
+        self.index_dir = index_dir
+        self.lats = np.load(os.path.join(index_dir, "lat.npy"), mmap_mode="r")
+        self.lons = np.load(os.path.join(index_dir, "lon.npy"), mmap_mode="r")
+        self.ids = np.load(os.path.join(index_dir, "ids.npy"), mmap_mode="r")
+        self.cells = np.load(os.path.join(index_dir, "cells.npy"), mmap_mode="r")
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(os.path.join(index_dir, "geonames.sqlite"), check_same_thread=False)
+        self.connection.row_factory = sqlite3.Row
+
+    def _candidates(self, row, col, reach):
+        """Offsets of the populated places in the cells at most reach cells from (row, col)."""
+        slices = []
+        cols = range(col - reach, col + reach + 1) if 2 * reach + 1 < COLS else range(COLS)
+        for r in range(max(0, row - reach), min(ROWS - 1, row + reach) + 1):
+            for c in cols:
+                cell = r * COLS + c % COLS
+                start, end = int(self.cells[cell]), int(self.cells[cell + 1])
+                if end > start:
+                    slices.append(np.arange(start, end))
+        return np.concatenate(slices) if slices else np.array([], dtype=np.int64)
+
+    def nearby(self, lat, lon, max_km=NEARBY_MAX_KM):
+        """The populated place closest to (lat, lon), like findNearbyPlaceNameJSON; None if none within max_km."""
+        lat, lon = float(lat), float(lon)
+        row, col = cell_of(lat, lon)
+        reach = 1
+        while True:
+            offsets = self._candidates(row, col, reach)
+            # Every place within `covered` km lies in the cells searched so far.
+            covered = reach * CELL_DEG * KM_PER_DEGREE * math.cos(math.radians(min(89.0, abs(lat) + reach * CELL_DEG)))
+            if len(offsets):
+                distances = haversine_one_to_many(math.radians(lat), math.radians(lon),
+                                                  np.radians(self.lats[offsets]), np.radians(self.lons[offsets]))
+                best = int(np.argmin(distances))
+                if distances[best] <= covered or covered >= max_km:
+                    if distances[best] > max_km:
+                        return None
+                    place = self.get(int(self.ids[offsets[best]]))
+                    if place:
+                        place["distance"] = f"{distances[best]:.5f}"
+                    return place
+            elif covered >= max_km:
+                return None
+            reach *= 2
+
+    def search(self, label):
+        """The most populous place with label as name, ASCII name or alternate name, like searchJSON with maxRows=1."""
+        with self.lock:
+            row = self.connection.execute(
+                "SELECT p.* FROM names n JOIN places p ON p.geonameid = n.geonameid "
+                "WHERE n.name = ? ORDER BY p.population DESC, p.geonameid LIMIT 1", (name_key(label),)).fetchone()
+        return self._entry(row)
+
+    def get(self, geonameid):
+        with self.lock:
+            row = self.connection.execute("SELECT * FROM places WHERE geonameid = ?", (geonameid,)).fetchone()
+        return self._entry(row)
+
+    @staticmethod
+    def _entry(row):
+        if row is None:
+            return None
+        return {
+            "geonameId": row["geonameid"],
+            "name": row["name"],
+            "toponymName": row["name"],
+            "lat": row["lat"],
+            "lng": row["lng"],
+            "adminName1": row["adminName1"],
+            "countryCode": row["countryCode"],
+            "countryName": row["countryName"],
+            "fcl": row["fcl"],
+            "fcode": row["fcode"],
+            "population": row["population"],
+        }
+
+    def close(self):
+        self.connection.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Build an offline GeoNames index from a GeoNames dump.")
+    parser.add_argument("dump_path", help="GeoNames dump, e.g. allCountries.txt or GR.txt.")
+    parser.add_argument("index_dir", help="Directory to write the index to, e.g. geonames_index.")
+    parser.add_argument("--admin1", help="admin1CodesASCII.txt, to fill adminName1.")
+    parser.add_argument("--countries", help="countryInfo.txt, to fill countryName.")
+    args = parser.parse_args()
+
+    if not os.path.exists(args.dump_path):
+        parser.error(f"{args.dump_path} does not exist")
+    count = build_index(args.dump_path, args.index_dir, args.admin1, args.countries)
+    print(f"Indexed {count} GeoNames places into {args.index_dir}.")
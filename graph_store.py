@@ -0,0 +1,105 @@
+# ------------------ Local Graph Store ------------------
+
+import re
+import threading
+from rdflib import BNode, Dataset, Graph, Literal, URIRef
+from rdflib.namespace import OWL, RDF, RDFS, XSD
+from rdflib.util import guess_format
+
+SPARQL_PREFIXES = {"rdf": RDF, "rdfs": RDFS, "owl": OWL, "xsd": XSD}  # predeclared by Virtuoso
+VIRTUOSO_PRAGMA = re.compile(r"^\s*DEFINE\s+\S+\s+\S+\s*$", re.MULTILINE | re.IGNORECASE)
+QUERY_PROLOGUE = re.compile(r"^\s*(?:#[^\n]*|PREFIX\s+\S*\s*<[^>]*>|BASE\s*<[^>]*>|DEFINE\s+\S+\s+\S+)\s*", re.IGNORECASE)
+QUAD_FORMATS = ("trig", "nquads", "trix")
+UPDATE_KEYWORDS = {"INSERT", "DELETE", "WITH", "LOAD", "CLEAR", "CREATE", "DROP", "COPY", "MOVE", "ADD"}
+DUMP_GRAPH = "http://localhost:8890/dataspace"  # graph that triple dumps are loaded into (the Virtuoso data graph)
+CUSTOM_GRAPHS = "https://crm-eq.ics.forth.gr/ontology#/custom/"  # graphs the pipeline writes links and enrichment to
+
+def is_update(query):
+    """Whether a SPARQL request is an update (INSERT/DELETE/...) rather than a query."""
+    body = query
+    while True:
+        match = QUERY_PROLOGUE.match(body)
+        if not match or not match.group(0):
+            break
+        body = body[match.end():]
+    keyword = re.match(r"\s*(\w+)", body)
+    return bool(keyword) and keyword.group(1).upper() in UPDATE_KEYWORDS
+
+def json_term(term):
+    """An rdflib term as a SPARQL 1.1 JSON results binding."""
+    if isinstance(term, URIRef):
+        return {"type": "uri", "value": str(term)}
+    if isinstance(term, BNode):
+        return {"type": "bnode", "value": str(term)}
+    binding = {"type": "literal", "value": str(term)}
+    if isinstance(term, Literal):
+        if term.language:
+            binding["xml:lang"] = term.language
+        elif term.datatype:
+            binding["datatype"] = str(term.datatype)
+    return binding
+
+class LocalGraphStore:
+    """
+    SPARQL query/update engine over an rdflib Dataset, used in place of the SPARQL endpoint
+    (config.use_local_graph); select/update match sparql_client.SparqlEndpoint.
+    Virtuoso DEFINE pragmas are dropped and the rdf/rdfs/owl/xsd prefixes are predeclared.
+    Requests are serialized behind a lock, so readers and writers on different threads are safe.
+    """
+
+    def __init__(self, dataset):
+        self.dataset = dataset
+        self.lock = threading.Lock()
+
+    def select(self, query):
+        """Run a SELECT query and return its results in the SPARQL JSON results shape."""
+        with self.lock:
+            result = self.dataset.query(VIRTUOSO_PRAGMA.sub("", query), initNs=SPARQL_PREFIXES)
+            variables = [str(var) for var in result.vars]
+            bindings = [{var: json_term(value) for var, value in zip(variables, row) if value is not None}
+                        for row in result]
+        return {"head": {"vars": variables}, "results": {"bindings": bindings}}
+
+    def update(self, query):
+        with self.lock:
+            self.dataset.update(VIRTUOSO_PRAGMA.sub("", query), initNs=SPARQL_PREFIXES)
+
+    def save_links(self, path, prefix=CUSTOM_GRAPHS):
+        """
+        Write the named graphs under prefix (the links and enrichment the pipeline inserted) to path.
+        The RDF format follows the file extension (N-Quads when unknown); triple formats such as
+        Turtle or N-Triples get the graphs merged. Returns the triple count.
+        """
+        rdf_format = guess_format(path) or "nquads"
+        output = Dataset() if rdf_format in QUAD_FORMATS else Graph()
+        count = 0
+        with self.lock:
+            for graph in self.dataset.graphs():
+                if str(graph.identifier).startswith(prefix):
+                    target = output.graph(graph.identifier) if rdf_format in QUAD_FORMATS else output
+                    for triple in graph:
+                        target.add(triple)
+                        count += 1
+        output.serialize(path, format=rdf_format, encoding="utf-8")
+        return count
+
+    def close(self):
+        self.dataset.close()
+
+def load_local_graph(paths, store="Memory", db_path=None, graph=DUMP_GRAPH):
+    """
+    Load RDF dumps (N-Triples, Turtle, TriG, N-Quads, ...; format from the file extension) into a
+    LocalGraphStore. Triple dumps go into graph; quad dumps keep their graphs.
+    With a persistent rdflib store (e.g. "BerkeleyDB" or "Oxigraph", if installed) the dataset is
+    opened at db_path, so a dump loaded once can be reused by passing no paths.
+    """
+    dataset = Dataset(store=store, default_union=True)
+    if store != "Memory":
+        dataset.open(db_path, create=True)
+    for path in paths:
+        rdf_format = guess_format(path) or "nt"
+        if rdf_format in QUAD_FORMATS:
+            dataset.parse(path, format=rdf_format)
+        else:
+            dataset.graph(URIRef(graph)).parse(path, format=rdf_format)
+    return LocalGraphStore(dataset)
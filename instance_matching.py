@@ -4,17 +4,34 @@ from fuzzywuzzy import fuzz
 from dotenv import load_dotenv
 import os
 import argparse
+import logging
 
 from person_enrichment import get_wikidata_enrichment_data   
-from utils import insert_same_as, insert_close_match
+from utils import insert_same_as, insert_close_match, run_stages, LINK_MODES
 from match_eq import match_earthquakes, normalize_dates
 from match_places import enrich_places, match_places
-from config import sparql, GEONAMES_USERNAME
+from config import sparql, GEONAMES_USERNAME, GEONAMES_INDEX, WIKIDATA_INDEX, MATCH_WORKERS, STAGE_WORKERS, LOCAL_GRAPH, LOCAL_GRAPH_STORE, LOCAL_GRAPH_DB, LOCAL_GRAPH_OUTPUT, LOG_LEVEL, METRICS_OUTPUT, use_local_graph, use_export
+from graph_store import load_local_graph
+from link_export import TripleExport, EXPORT_FORMATS
+from metrics import metrics
 from person_match import enrich_persons,match_persons
 
+logger = logging.getLogger("instance_matching")
+
 
 # ------------------ Main Steps ------------------
 
+# Stages each pipeline stage waits for, when they are selected too. Earthquake matching reads the
+# normalized dates and the places' sameAs coordinates; place and person stages are independent.
+STAGE_DEPENDENCIES = {
+    "normalize_dates": (),
+    "enrich_places": (),
+    "match_places": ("enrich_places",),
+    "enrich_persons": (),
+    "match_persons": ("enrich_persons",),
+    "match_earthquakes": ("normalize_dates", "enrich_places", "match_places"),
+}
+
 def main():
     parser = argparse.ArgumentParser(description="Instance Matching for Places, Persons, and Earthquakes.")
     parser.add_argument("--all", action="store_true", help="Run all matching processes.")
@@ -23,29 +40,80 @@ def main():
     parser.add_argument("--place", action="store_true", help="Run place matching.")
     parser.add_argument("--eq", action="store_true", help="Run earthquake matching.")
     parser.add_argument("--dates", action="store_true", help="Run date normalization.")
+    parser.add_argument("--person-blocking", action="store_true",
+                        help="Only compare persons that share a name token, a Wikidata URI or a birth/death decade; misspelled names may be missed.")
+    parser.add_argument("--eq-blocking", action="store_true",
+                        help="Only compare earthquakes that share a year or a region; drops the cross-year month-only and label-only rules.")
+    parser.add_argument("--incremental", action="store_true", help="Only compare entities that are new or changed since the last matching run.")
+    parser.add_argument("--workers", type=int, default=MATCH_WORKERS, help="Number of processes scoring candidate pairs (1 = serial).")
+    parser.add_argument("--stage-workers", type=int, default=STAGE_WORKERS,
+                        help="Number of pipeline stages run at the same time (1 = one after the other).")
+    parser.add_argument("--geonames-index", default=GEONAMES_INDEX,
+                        help="Offline GeoNames index directory (built with geonames_offline.py) to enrich places without the web services.")
+    parser.add_argument("--wikidata-index", default=WIKIDATA_INDEX,
+                        help="Offline Wikidata index file (built with wikidata_offline.py) to enrich persons without the query service.")
+    parser.add_argument("--links", choices=LINK_MODES, default="clique",
+                        help="sameAs output: every matched pair (clique), only links joining clusters (spanning), or one link per member to its cluster representative (canonical).")
+    parser.add_argument("--local-graph", nargs="+", default=LOCAL_GRAPH, metavar="DUMP",
+                        help="Run against local RDF dumps (N-Triples, Turtle, TriG, N-Quads) instead of the SPARQL endpoint.")
+    parser.add_argument("--local-graph-output", default=LOCAL_GRAPH_OUTPUT,
+                        help="File the links and enrichment of a --local-graph run are written to (format from the extension).")
+    parser.add_argument("--export", metavar="DIR",
+                        help="Write links and enrichment as N-Triples files per graph to DIR (for Virtuoso's bulk loader) instead of updating the endpoint.")
+    parser.add_argument("--export-format", choices=EXPORT_FORMATS, default="nt",
+                        help="nt: one .nt file per graph with a .graph file naming it; nq: one .nq file per graph.")
+    parser.add_argument("--dry-run", action="store_true", help="Run without writing anything to the endpoint, the export files or the match snapshot; only report the triple counts.")
+    parser.add_argument("--log-level", default=LOG_LEVEL, choices=["DEBUG", "INFO", "WARNING", "ERROR"],
+                        help="DEBUG also logs every match decision and service call.")
+    parser.add_argument("--metrics-output", default=METRICS_OUTPUT,
+                        help="File the JSON metrics (stage timers, counters, request latencies) are written to.")
 
     args = parser.parse_args()
     cache_usage_flag = args.cache
+    logging.basicConfig(level=args.log_level, format="%(message)s")
 
-    print("\nStarting instance matching process...")
+    local_store = None
+    if args.local_graph or LOCAL_GRAPH_STORE != "Memory":
+        logger.info(f"\nLoading local graph from {', '.join(args.local_graph) or LOCAL_GRAPH_DB}...")
+        with metrics.stage("load_local_graph"):
+            local_store = load_local_graph(args.local_graph, LOCAL_GRAPH_STORE, LOCAL_GRAPH_DB)
+        use_local_graph(local_store)
 
-    if args.all or args.dates:
-        print("\nStep 1: Normalizing dates...")
-        normalize_dates()
+    exporter = None
+    if args.export or args.dry_run:
+        exporter = TripleExport(None if args.dry_run else args.export, args.export_format)
+        use_export(exporter)
 
-    if args.all or args.place:
-        print("\nStep 2: Enriching and matching places...")
-        enrich_places(cache_usage_flag)
-        match_places()
+    logger.info("\nStarting instance matching process...")
 
+    steps = {}
+    if args.all or args.dates:
+        steps["normalize_dates"] = normalize_dates
+    if args.all or args.place:
+        steps["enrich_places"] = lambda: enrich_places(cache_usage_flag, geonames_index=args.geonames_index)
+        steps["match_places"] = lambda: match_places(args.incremental, args.workers, args.links)
     if args.all or args.person:
-        print("\nStep 3: Enriching and matching persons...")
-        enrich_persons(cache_usage_flag)      
-        match_persons()
-
+        steps["enrich_persons"] = lambda: enrich_persons(cache_usage_flag, wikidata_index=args.wikidata_index)
+        steps["match_persons"] = lambda: match_persons(not args.person_blocking, incremental=args.incremental,
+                                                       workers=args.workers, link_mode=args.links)
     if args.all or args.eq:
-        print("\nStep 4: Matching earthquakes (including location proximity)...")
-        match_earthquakes()
+        steps["match_earthquakes"] = lambda: match_earthquakes(not args.eq_blocking, args.incremental, args.workers, args.links)
+    stages = {name: (step, STAGE_DEPENDENCIES[name]) for name, step in steps.items()}
+    run_stages(stages, args.stage_workers)
+    metrics.log_timeline()
+
+    if exporter is not None:
+        exporter.close()
+
+    if local_store is not None:
+        if exporter is None:
+            count = local_store.save_links(args.local_graph_output)
+            logger.info(f"\nWrote {count} link and enrichment triples to {args.local_graph_output}.")
+        local_store.close()
+
+    if args.metrics_output:
+        metrics.dump(args.metrics_output)
+        logger.info(f"\nWrote run metrics to {args.metrics_output}.")
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,78 @@
+# ------------------ Triple Export ------------------
+
+import logging
+import os
+import re
+import threading
+from metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+EXPORT_FORMATS = ("nt", "nq")
+
+def graph_file_name(graph):
+    """File name stem of a named graph: its last path segment, e.g. places for custom/places."""
+    return re.sub(r"\W+", "_", graph.rstrip("/").rsplit("/", 1)[-1].rsplit("#", 1)[-1]) or "default"
+
+class TripleExport:
+    """
+    Receives the pipeline's writes instead of the endpoint (config.use_export).
+    write(graph, triples) appends N-Triples lines to one file per named graph in directory:
+    <name>.nt with a <name>.nt.graph file holding the graph IRI, as Virtuoso's bulk loader
+    (ld_dir / rdf_loader_run) expects, or <name>.nq with the graph in every line (export_format "nq").
+    Other updates (the date rewrites of --dates) cannot be bulk loaded; they are appended to updates.sql
+    as SPARQL statements for Virtuoso's isql.
+    Files are rewritten by every run. With directory None nothing is written and the triples are only counted (a dry run).
+    """
+
+    def __init__(self, directory=None, export_format="nt"):
+        self.directory = directory
+        self.export_format = export_format
+        self.files = {}
+        self.counts = {}
+        self.updates = 0
+        self.updates_file = None
+        self.lock = threading.Lock()
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+    def file(self, graph):
+        if graph not in self.files:
+            path = os.path.join(self.directory, f"{graph_file_name(graph)}.{self.export_format}")
+            if self.export_format == "nt":
+                with open(f"{path}.graph", "w", encoding="utf-8") as f:
+                    f.write(graph + "\n")
+            self.files[graph] = open(path, "w", encoding="utf-8")
+        return self.files[graph]
+
+    def write(self, graph, triples):
+        with self.lock:
+            self.counts[graph] = self.counts.get(graph, 0) + len(triples)
+            if self.directory:
+                if self.export_format == "nq":
+                    lines = [f"{triple[:-1].rstrip()} <{graph}> .\n" for triple in triples]
+                else:
+                    lines = [f"{triple}\n" for triple in triples]
+                self.file(graph).writelines(lines)
+        metrics.count(f"exported.{graph_file_name(graph)}", len(triples))
+
+    def update(self, query):
+        with self.lock:
+            self.updates += 1
+            if self.directory:
+                if self.updates_file is None:
+                    self.updates_file = open(os.path.join(self.directory, "updates.sql"), "w", encoding="utf-8")
+                self.updates_file.write(f"SPARQL {query.strip()};\n\n")
+
+    def close(self):
+        with self.lock:
+            for f in [*self.files.values(), self.updates_file]:
+                if f is not None:
+                    f.close()
+            self.files = {}
+            self.updates_file = None
+        target = self.directory or "nowhere (dry run)"
+        for graph, count in sorted(self.counts.items()):
+            logger.info(f"Exported {count} triples of <{graph}> to {target}.")
+        if self.updates:
+            logger.info(f"Exported {self.updates} other updates to {target}.")
@@ -0,0 +1,163 @@
+# ------------------ Local Endpoint Stand-ins ------------------
+
+import hashlib
+import json
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+from graph_store import LocalGraphStore
+
+VALUES_NAME = re.compile(r'"((?:[^"\\]|\\.)*)"@en')
+
+def stable_hash(text):
+    return int(hashlib.sha1(text.encode("utf-8")).hexdigest()[:8], 16)
+
+class LocalServer:
+    """
+    Threaded HTTP server on a free localhost port, running in a daemon thread.
+    Subclasses implement handle(path, params, method) -> (status, content type, body) and
+    count requests by kind in self.requests. latency (seconds) is added to every response.
+    Use it as a context manager to start and stop it.
+    """
+
+    def __init__(self, latency=0.0):
+        self.latency = latency
+        self.requests = {}
+        self.lock = threading.Lock()
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"  # keep-alive, like the real services
+            disable_nagle_algorithm = True  # headers and body are separate writes
+
+            def do_GET(self):
+                url = urlparse(self.path)
+                self.respond(url.path, parse_qs(url.query), "GET")
+
+            def do_POST(self):
+                url = urlparse(self.path)
+                body = self.rfile.read(int(self.headers.get("Content-Length", 0))).decode("utf-8")
+                self.respond(url.path, {**parse_qs(url.query), **parse_qs(body)}, "POST")
+
+            def respond(self, path, params, method):
+                if server.latency:
+                    time.sleep(server.latency)
+                try:
+                    status, content_type, body = server.handle(path, {k: v[0] for k, v in params.items()}, method)
+                except Exception as e:
+                    status, content_type, body = 400, "text/plain", str(e).encode("utf-8")
+                self.send_response(status)
+                self.send_header("Content-Type", content_type)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.httpd = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+
+    @property
+    def url(self):
+        host, port = self.httpd.server_address
+        return f"http://{host}:{port}"
+
+    def count(self, kind):
+        with self.lock:
+            self.requests[kind] = self.requests.get(kind, 0) + 1
+
+    def handle(self, path, params, method):
+        raise NotImplementedError
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc, tb):
+        self.stop()
+        return False
+
+class SparqlStandIn(LocalServer):
+    """
+    SPARQL 1.1 protocol endpoint over an rdflib Dataset (through a graph_store.LocalGraphStore),
+    standing in for Virtuoso: queries (GET/POST "query") return SPARQL JSON results, updates
+    (POST "update") modify the dataset. Requests are counted as "query" and "update".
+    The endpoint URL is url + "/sparql".
+    """
+
+    def __init__(self, dataset, latency=0.0):
+        super().__init__(latency)
+        self.store = LocalGraphStore(dataset)
+
+    @property
+    def endpoint(self):
+        return f"{self.url}/sparql"
+
+    def handle(self, path, params, method):
+        if "update" in params:
+            self.count("update")
+            self.store.update(params["update"])
+            return 200, "application/json", b"{}"
+        self.count("query")
+        body = json.dumps(self.store.select(params["query"])).encode("utf-8")
+        return 200, "application/sparql-results+json", body
+
+class GeoNamesStub(LocalServer):
+    """
+    findNearbyPlaceNameJSON / searchJSON stub. Places come from a 0.01 degree grid (nearby)
+    or from the query text (search), so close coordinates and equal labels share a geonameId.
+    Requests are counted by service name.
+    """
+
+    def handle(self, path, params, method):
+        service = path.strip("/")
+        self.count(service)
+        if service == "findNearbyPlaceNameJSON":
+            lat, lng = round(float(params["lat"]), 2), round(float(params["lng"]), 2)
+            key = f"{lat:.2f},{lng:.2f}"
+            name = f"Place {key}"
+        elif service == "searchJSON":
+            key = params.get("q", "").lower()
+            name = params.get("q", "")
+            lat, lng = 35 + stable_hash(key) % 600 / 100, 20 + stable_hash(key[::-1]) % 800 / 100
+        else:
+            return 404, "application/json", b'{"status": {"message": "unknown service", "value": 11}}'
+        entry = {"geonameId": stable_hash(key), "name": name, "toponymName": name, "lat": str(lat), "lng": str(lng),
+                 "adminName1": "Synthetic Region", "countryName": "Greece", "countryCode": "GR", "fcl": "P"}
+        return 200, "application/json", json.dumps({"geonames": [entry]}).encode("utf-8")
+
+class WikidataStub(LocalServer):
+    """
+    Wikidata query service stub for the label and family-name VALUES queries of person_enrichment.
+    Roughly half of the names resolve by label and a third by family name, each to one human with
+    a birth date and a scholarly occupation. Requests are counted as "label" and "family_name".
+    """
+
+    def handle(self, path, params, method):
+        query = params.get("query", "")
+        family_name = "P734" in query
+        self.count("family_name" if family_name else "label")
+        bindings = []
+        for raw in VALUES_NAME.findall(query):
+            name = raw.replace('\\"', '"').replace("\\\\", "\\")
+            h = stable_hash(name)
+            if (h % 3 != 0) if family_name else (h % 2 != 0):
+                continue
+            bindings.append({
+                "name": {"type": "literal", "value": name, "xml:lang": "en"},
+                "person": {"type": "uri", "value": f"http://www.wikidata.org/entity/Q{h}"},
+                "personLabel": {"type": "literal", "value": name, "xml:lang": "en"},
+                "birthDate": {"type": "literal", "value": f"{1000 + h % 900}-01-01T00:00:00Z"},
+                "occupationLabel": {"type": "literal", "value": "historian", "xml:lang": "en"},
+            })
+        return 200, "application/sparql-results+json", json.dumps({"results": {"bindings": bindings}}).encode("utf-8")
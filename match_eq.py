@@ -1,20 +1,63 @@
 from SPARQLWrapper import SPARQLWrapper, JSON, POST , URLENCODED
 from fuzzywuzzy import fuzz
-from datetime import datetime, timedelta
+from datetime import datetime
 import re
 import os
-from dateutil import parser
-from utils import insert_same_as, insert_close_match, haversine 
-from config import sparql
+import logging
+import numpy as np
+from utils import write_matches, MatchSnapshot, SAME_AS, CLOSE_MATCH, all_partners, candidate_partners, incremental_partners, parse_coordinates, GridIndex, haversine_one_to_many, sparql_string, paged_select, collect_decisions
+from config import sparql, DATE_BATCH_SIZE, PAGE_SIZE, MATCH_WORKERS
+from date_parsing import normalize_date_string, extract_year, extract_datetime
+from metrics import metrics
+
+logger = logging.getLogger(__name__)
 
 
 
 EARTHQUAKE_DATE_THRESHOLD = 1 # max year difference for earthquakes
 EARTHQUAKE_COORD_THRESHOLD = 50  # km for earthquakes
+EPOCH = datetime(1970, 1, 1)
 
 # ------------------ Date Extraction & Comparison ------------------
 
-def normalize_dates():
+DATE_GRAPH = "http://localhost:8890/dataspace"
+XSD_DATETIME = "http://www.w3.org/2001/XMLSchema#dateTime"
+
+def date_rewrite_query(rows):
+    """
+    Build one DELETE/INSERT update that rewrites every (sub, property, value, normalized)
+    row of the batch, driven by a VALUES block.
+    """
+    values = "\n".join(
+        f"                (<{sub}> <{date_property}> {sparql_string(date_value)} {sparql_string(normalized_value)}^^xsd:dateTime)"
+        for sub, date_property, date_value, normalized_value in rows
+    )
+    return f"""
+    DEFINE sql:big-data-const 0
+    PREFIX xsd: <http://www.w3.org/2001/XMLSchema#>
+    DELETE {{
+        GRAPH <{DATE_GRAPH}> {{ ?sub ?dateProperty ?dateValue . }}
+    }}
+    INSERT {{
+        GRAPH <{DATE_GRAPH}> {{ ?sub ?dateProperty ?normalizedValue . }}
+    }}
+    WHERE {{
+        GRAPH <{DATE_GRAPH}> {{
+            VALUES (?sub ?dateProperty ?dateValue ?normalizedValue) {{
+{values}
+            }}
+            ?sub ?dateProperty ?dateValue .
+        }}
+    }}
+    """
+
+def normalize_dates(batch_size=DATE_BATCH_SIZE, page_size=PAGE_SIZE):
+    """
+    Rewrite the time-span date literals as xsd:dateTime values.
+    Each distinct literal is normalized once and the rewrites are sent in batches of batch_size rows.
+    YYYY-MM-DD_HH:MM literals are kept as they are: earthquake matching reads their time of day
+    (extract_datetime), which an xsd:dateTime of a midnight event could not be told from a plain date.
+    """
     query = """
     PREFIX crm: <http://www.cidoc-crm.org/cidoc-crm/>
     SELECT ?sub ?dateProperty ?dateValue WHERE {
@@ -29,117 +72,48 @@ def normalize_dates():
         
     }
     """
-    sparql.setQuery(query)
-    sparql.setMethod("GET")
-    results = sparql.query().convert()
-    
-    updates = []
-    
-    for result in results["results"]["bindings"]:
+    rows = []
+    literals = set()
+    skipped = 0
+    kept = 0
+    unparseable = 0
+    # Read every page before rewriting, so the updates cannot shift the pages still to be read.
+    for result in list(paged_select(query, "?sub ?dateProperty ?dateValue", page_size)):
+        if result["dateValue"].get("datatype") == XSD_DATETIME:
+            skipped += 1
+            continue
         sub = result["sub"]["value"]
         date_property = result["dateProperty"]["value"]
         date_value = result["dateValue"]["value"]
+        literals.add(date_value)
+        if extract_datetime(date_value):
+            kept += 1
+            continue
 
         normalized_value = normalize_date_string(date_value)
 
         if normalized_value:
             safe_sub = sub.replace("(", "").replace(")", "").replace("\\", "")
+            rows.append((safe_sub, date_property, date_value, normalized_value))
+        else:
+            unparseable += 1
 
-            update_query = f"""
-            DEFINE sql:big-data-const 0
-            DELETE {{
-                GRAPH <http://localhost:8890/dataspace> {{
-                    <{safe_sub}> <{date_property}> "{date_value}" .
-                }}
-            }}
-            INSERT {{
-                GRAPH <http://localhost:8890/dataspace> {{
-                    <{safe_sub}> <{date_property}> "{normalized_value}"^^xsd:dateTime .
-                }}
-            }}
-            WHERE {{
-                GRAPH <http://localhost:8890/dataspace> {{
-                    <{safe_sub}> <{date_property}> "{date_value}" .
-                }}
-            }}
-            """
-            updates.append(update_query)
-
-    for update in updates:
-        sparql.setQuery(update)
-        sparql.setMethod(POST)
-        sparql.query()
-
-def normalize_date_string(value):
-    """
-    Normalize dates in ISO 8601 format.
-    """
-    try:
-        dt = parser.parse(value)
-        return dt.isoformat()
-    except ValueError:
-        if re.match(r"^\d{4}$", value):  # YYYY
-            return f"{value}-01-01T00:00:00"
-        elif re.match(r"^\d{4}-\d{2}$", value):  # YYYY-MM
-            return f"{value}-01T00:00:00"
-        elif re.match(r"^\d{4}-\d{2}-\d{2}$", value):  # YYYY-MM-DD
-            return f"{value}T00:00:00"
-        elif "circa" in value.lower() or "c." in value.lower():
-            match = re.search(r"(\d{4})", value)
-            if match:
-                return f"{match.group(1)}-01-01T00:00:00"
-        elif re.match(r"^\d{4}-\d{4}$", value):  # YYYY-YYYY
-            years = value.split('-')
-            return f"{years[0]}-01-01T00:00:00/{years[1]}-12-31T23:59:59"
-
-    return None # cannot normalize
-
-def extract_year(date_string):
-    match = re.search(r'(\d{4})', date_string)
-    if match:
-        return int(match.group(1))
-    return None
-
-def extract_datetime(date_string):
-    if '#' in date_string:
-        date_string = date_string.split('#')[-1]
-    match = re.search(r'^(\d{4}-\d{2}-\d{2}_\d{2}:\d{2})', date_string)
-    if match:
-        dt_str = match.group(1)
-        try:
-            return datetime.strptime(dt_str, "%Y-%m-%d_%H:%M")
-        except ValueError:
-            return None
-    return None
-
-def is_close_datetime(date1, date2, hours_threshold=3):
-    dt1 = extract_datetime(date1)
-    dt2 = extract_datetime(date2)
-    if dt1 and dt2:
-        return abs(dt1 - dt2) <= timedelta(hours=hours_threshold)
-    return False
-
-def is_year_match(date1, date2, year_threshold=1):
-    dt1 = extract_datetime(date1)
-    dt2 = extract_datetime(date2)
-    if dt1 and dt2:
-        return abs(dt1.year - dt2.year) <= year_threshold
-    year1 = extract_year(date1)
-    year2 = extract_year(date2)
-    if year1 and year2:
-        return abs(year1 - year2) <= year_threshold
-    return False
-
-def is_month_match(date1, date2, month_threshold=1):
-    dt1 = extract_datetime(date1)
-    dt2 = extract_datetime(date2)
-    if dt1 and dt2:
-        return abs(dt1.month - dt2.month) <= month_threshold
-    return False
+    batch_size = max(1, batch_size)
+    requests_sent = 0
+    for start in range(0, len(rows), batch_size):
+        sparql.update(date_rewrite_query(rows[start:start + batch_size]))
+        requests_sent += 1
 
-# ------------------ Matching Earthquakes ------------------
+    metrics.count("dates.normalized", len(rows))
+    metrics.count("dates.kept", kept)
+    metrics.count("dates.unparseable", unparseable)
+    logger.info(f"Normalized {len(rows)} date values ({len(literals)} distinct literals) in {requests_sent} requests; "
+          f"skipped {skipped} already typed, kept {kept} with a time of day, {unparseable} unparseable.")
+
+# ------------------ Querying Earthquakes ------------------
 
-def query_earthquakes():
+def query_earthquakes(page_size=PAGE_SIZE, on_page=None):
+    """Query earthquakes from the endpoint page by page and return them as EarthquakeRecords."""
     query = """
     PREFIX rdf: <http://www.w3.org/1999/02/22-rdf-syntax-ns#>
     PREFIX rdfs: <http://www.w3.org/2000/01/rdf-schema#>
@@ -174,11 +148,8 @@ def query_earthquakes():
         ?geo  <http://www.w3.org/2003/01/geo/wgs84_pos#long> ?long. }
     }
     """
-    sparql.setQuery(query)
-    sparql.setMethod("GET")
-    results = sparql.query().convert()
     earthquakes = []
-    for result in results["results"]["bindings"]:
+    for result in paged_select(query, "?eq ?label ?begin ?end ?lat ?long", page_size, on_page):
         eq_id = result["eq"]["value"]
         label = result["label"]["value"]
         begin = result["begin"]["value"] if "begin" in result else None
@@ -186,54 +157,194 @@ def query_earthquakes():
         lat = result["lat"]["value"] if "lat" in result else None
         lon = result["long"]["value"] if "long" in result else None
         earthquakes.append((eq_id, label, begin, end, lat, lon))
-    return earthquakes
-
-def match_earthquakes():
-    earthquakes = query_earthquakes()
-    n = len(earthquakes)
-    for i in range(n):
-        eq1, label1, begin1, end1, lat1, lon1 = earthquakes[i]
-        for j in range(i+1, n):
-            eq2, label2, begin2, end2, lat2, lon2 = earthquakes[j]
-            if eq1 == eq2:
+    return EarthquakeRecords(earthquakes)
+
+class DateColumn:
+    """
+    Dates of one time-span property (begin or end), parsed once into NumPy columns:
+    present (non-empty literal), has_datetime/timestamp/dt_year/month (from extract_datetime)
+    and has_year/year (from extract_year).
+    """
+
+    def __init__(self, values):
+        n = len(values)
+        self.present = np.zeros(n, dtype=bool)
+        self.has_datetime = np.zeros(n, dtype=bool)
+        self.timestamp = np.zeros(n)
+        self.dt_year = np.zeros(n, dtype=np.int64)
+        self.month = np.zeros(n, dtype=np.int64)
+        self.has_year = np.zeros(n, dtype=bool)
+        self.year = np.zeros(n, dtype=np.int64)
+        for i, value in enumerate(values):
+            if not value:
                 continue
-            label_similarity = fuzz.ratio(label1, label2)
-            
-            exact_date_match = False
-            year_date_match = False
-            month_date_match = False
-
-            exact_date_match_end = False
-            year_date_match_end = False
-            month_date_match_end = False
-            
-
-            if begin1 and begin2:
-                exact_date_match = is_close_datetime(begin1, begin2, hours_threshold=3)
-                month_date_match = is_month_match(begin1, begin2, month_threshold=1)
-                year_date_match = is_year_match(begin1, begin2, year_threshold=EARTHQUAKE_DATE_THRESHOLD)
-            
-            if end1 and end2:
-                exact_date_match_end = is_close_datetime(end1, end2, hours_threshold=3)
-                month_date_match_end = is_month_match(end1, end2, month_threshold=1)
-                year_date_match_end = is_year_match(end1, end2, year_threshold=EARTHQUAKE_DATE_THRESHOLD)
-            
-            coord_match = False
-            if lat1 and lon1 and lat2 and lon2:
-                try:
-                    distance = haversine(float(lat1), float(lon1), float(lat2), float(lon2))
-                    if distance <= EARTHQUAKE_COORD_THRESHOLD:
-                        coord_match = True
-                except ValueError:
-                    pass
-            
-            if (label_similarity >= 85 and exact_date_match) or (label_similarity >=85 and exact_date_match_end) or (coord_match and exact_date_match) or (month_date_match and coord_match) or (month_date_match_end and coord_match) or (label_similarity >= 95):
-                print(f"Inserting owl:sameAs for earthquakes (exact match):") 
-                print(f"  {eq1} ({label1}, begin: {begin1}, end: {end1}, {lat1}, {lon1})")
-                print(f"  {eq2} ({label2}, begin: {begin2}, end:{end2}, {lat2}, {lon2})")
-                insert_same_as(eq1, eq2, "earthquakes")
-            elif (label_similarity >= 90 and year_date_match) or (coord_match and (year_date_match or year_date_match_end)) or ((month_date_match or month_date_match_end) and coord_match) or (month_date_match) or month_date_match_end or (label_similarity >= 80):
-                print(f"Inserting closeMatch for earthquakes:")
-                print(f"  {eq1} ({label1}, begin: {begin1}, end :{end1}, {lat1}, {lon1})")
-                print(f"  {eq2} ({label2}, begin: {begin2}, end:{end2}, {lat2}, {lon2})")
-                insert_close_match(eq1, eq2, "earthquakes")
+            self.present[i] = True
+            dt = extract_datetime(value)
+            if dt:
+                self.has_datetime[i] = True
+                self.timestamp[i] = (dt - EPOCH).total_seconds()
+                self.dt_year[i] = dt.year
+                self.month[i] = dt.month
+            year = extract_year(value)
+            if year:
+                self.has_year[i] = True
+                self.year[i] = year
+
+    def block_year(self, i):
+        """Year used for blocking: the datetime year if there is one, else the plain year."""
+        if self.has_datetime[i]:
+            return int(self.dt_year[i])
+        if self.has_year[i]:
+            return int(self.year[i])
+        return None
+
+    def matches(self, i, js, hours_threshold=3, month_threshold=1, year_threshold=EARTHQUAKE_DATE_THRESHOLD):
+        """
+        Date rules of record i against records js: both datetimes within hours_threshold hours (exact),
+        their months at most month_threshold apart (month), and their years, or else the plain years
+        of the literals, at most year_threshold apart (year). Returns the three boolean arrays.
+        """
+        both = self.present[i] & self.present[js]
+        both_datetime = both & self.has_datetime[i] & self.has_datetime[js]
+        exact = both_datetime & (np.abs(self.timestamp[js] - self.timestamp[i]) <= hours_threshold * 3600)
+        month = both_datetime & (np.abs(self.month[js] - self.month[i]) <= month_threshold)
+        both_year = both & self.has_year[i] & self.has_year[js]
+        year = np.where(both_datetime,
+                        np.abs(self.dt_year[js] - self.dt_year[i]) <= year_threshold,
+                        both_year & (np.abs(self.year[js] - self.year[i]) <= year_threshold))
+        return exact, month, year
+
+class EarthquakeRecords:
+    """
+    Earthquake rows in columnar form: ids, labels and raw dates as lists (for messages),
+    begin/end dates as DateColumns and coordinates as float arrays (NaN when missing).
+    """
+
+    def __init__(self, rows):
+        self.rows = rows
+        self.ids = [row[0] for row in rows]
+        self.labels = [row[1] for row in rows]
+        codes = {}
+        self.id_codes = np.array([codes.setdefault(eq_id, len(codes)) for eq_id in self.ids], dtype=np.int64)
+        self.begin = DateColumn([row[2] for row in rows])
+        self.end = DateColumn([row[3] for row in rows])
+        self.lat = parse_coordinates([row[4] for row in rows])
+        self.lon = parse_coordinates([row[5] for row in rows])
+        self.lat_rad = np.radians(self.lat)
+        self.lon_rad = np.radians(self.lon)
+        self.located = ~(np.isnan(self.lat) | np.isnan(self.lon))
+
+    def __len__(self):
+        return len(self.rows)
+
+    def __getitem__(self, i):
+        return self.rows[i]
+
+    def coord_matches(self, i, js, threshold=EARTHQUAKE_COORD_THRESHOLD):
+        """Vectorized distance check of record i against records js."""
+        if not self.located[i]:
+            return np.zeros(len(js), dtype=bool)
+        distances = haversine_one_to_many(self.lat_rad[i], self.lon_rad[i], self.lat_rad[js], self.lon_rad[js])
+        return self.located[js] & (distances <= threshold)
+
+# ------------------ Blocking Earthquakes ------------------
+
+def earthquake_block_keys(records, i):
+    """
+    Temporal blocking keys of earthquake i: one key per year found in begin/end.
+    Earthquakes with neither a year nor coordinates share a single fallback block.
+    """
+    keys = set()
+    for column in (records.begin, records.end):
+        year = column.block_year(i)
+        if year:
+            keys.add(("year", year))
+    if not keys and not records.located[i]:
+        keys.add(("unkeyed",))
+    return keys
+
+def earthquake_neighbour_keys(key):
+    """Keys whose earthquakes may satisfy a year rule together with `key`."""
+    if key[0] == "year":
+        year = key[1]
+        return [("year", year + d) for d in range(-EARTHQUAKE_DATE_THRESHOLD, EARTHQUAKE_DATE_THRESHOLD + 1)]
+    return [key]
+
+def earthquake_candidate_blocks(records, exhaustive=False):
+    """
+    Candidate blocks for the earthquake rules, as (i, partners) with partners j > i:
+    earthquakes whose years are within EARTHQUAKE_DATE_THRESHOLD, plus those within
+    EARTHQUAKE_COORD_THRESHOLD of each other. With exhaustive=True every pair is returned.
+    Pairs outside these blocks can still satisfy the month-only and label-only rules, see --eq-blocking in the README.
+    """
+    n = len(records)
+    if exhaustive:
+        return all_partners(n)
+    close_pairs = GridIndex(records.lat, records.lon, EARTHQUAKE_COORD_THRESHOLD).pairs_within(EARTHQUAKE_COORD_THRESHOLD)
+    block_keys = [earthquake_block_keys(records, i) for i in range(n)]
+    return candidate_partners(block_keys, earthquake_neighbour_keys, close_pairs)
+
+# ------------------ Matching Earthquakes ------------------
+
+def score_earthquake_blocks(records, blocks, clusters=None):
+    """
+    Apply the earthquake rules to (i, partners) candidate blocks.
+    Returns (decisions, compared) where decisions are (eq1, eq2, link type, rule, message) tuples in block order;
+    messages are only built when debug logging is on.
+    """
+    decisions, decide = collect_decisions(clusters, logger)
+    compared = 0
+
+    for i, partners in blocks:
+        js = np.asarray(partners, dtype=np.int64)
+        js = js[records.id_codes[js] != records.id_codes[i]]
+        if clusters is not None:
+            js = js[np.array([not clusters.connected(records.ids[i], records.ids[j]) for j in js], dtype=bool)]
+        if not len(js):
+            continue
+        compared += len(js)
+
+        exact_date_match, month_date_match, year_date_match = records.begin.matches(i, js)
+        exact_date_match_end, month_date_match_end, year_date_match_end = records.end.matches(i, js)
+        coord_match = records.coord_matches(i, js)
+        label1 = records.labels[i]
+        label_similarity = np.array([fuzz.ratio(label1, records.labels[j]) for j in js])
+
+        same_as = ((label_similarity >= 85) & exact_date_match) | ((label_similarity >= 85) & exact_date_match_end) | (coord_match & exact_date_match) | (month_date_match & coord_match) | (month_date_match_end & coord_match) | (label_similarity >= 95)
+        close_match = ~same_as & (((label_similarity >= 90) & year_date_match) | (coord_match & (year_date_match | year_date_match_end)) | ((month_date_match | month_date_match_end) & coord_match) | month_date_match | month_date_match_end | (label_similarity >= 80))
+
+        eq1, label1, begin1, end1, lat1, lon1 = records[i]
+        for k in np.flatnonzero(same_as | close_match):
+            eq2, label2, begin2, end2, lat2, lon2 = records[js[k]]
+            if same_as[k]:
+                decide(eq1, eq2, SAME_AS, "exact_match",
+                       lambda: f"Inserting owl:sameAs for earthquakes (exact match):\n"
+                               f"  {eq1} ({label1}, begin: {begin1}, end: {end1}, {lat1}, {lon1})\n"
+                               f"  {eq2} ({label2}, begin: {begin2}, end:{end2}, {lat2}, {lon2})")
+            else:
+                decide(eq1, eq2, CLOSE_MATCH, "close_match",
+                       lambda: f"Inserting closeMatch for earthquakes:\n"
+                               f"  {eq1} ({label1}, begin: {begin1}, end :{end1}, {lat1}, {lon1})\n"
+                               f"  {eq2} ({label2}, begin: {begin2}, end:{end2}, {lat2}, {lon2})")
+    return decisions, compared
+
+def match_earthquakes(exhaustive=True, incremental=False, workers=MATCH_WORKERS, link_mode="clique"):
+    """
+    Match earthquakes pairwise with the sameAs/closeMatch rules of score_earthquake_blocks.
+    Every pair is compared unless exhaustive is False, which compares the year and grid blocks only.
+    Returns the number of pairs compared.
+    """
+    records = query_earthquakes()
+    n = len(records)
+    total_pairs = n * (n - 1) // 2
+    snapshot = MatchSnapshot("earthquakes")
+    blocks = earthquake_candidate_blocks(records, exhaustive)
+    if incremental:
+        changed = snapshot.changed(records.rows)
+        logger.info(f"Incremental run: {len(changed)} of {n} earthquake rows are new or changed.")
+        blocks = incremental_partners(blocks, changed)
+    compared = write_matches("earthquakes", score_earthquake_blocks, records, blocks, workers, link_mode, snapshot, records.rows)
+    snapshot.close()
+    ratio = compared / total_pairs * 100 if total_pairs else 0
+    logger.info(f"Compared {compared} of {total_pairs} earthquake pairs ({ratio:.1f}%).")
+    return compared
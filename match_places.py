@@ -2,32 +2,42 @@ from rdflib import Namespace
 from SPARQLWrapper import SPARQLWrapper, JSON, POST
 import os
 from fuzzywuzzy import fuzz
-from utils import insert_same_as, haversine
+from utils import custom_graph, literal_triple, OWL_SAME_AS, write_matches, MatchSnapshot, SAME_AS, all_partners, incremental_partners, parse_coordinates, GridIndex, TokenBucket, SingleFlight, ordered_pipeline, paged_select, collect_decisions
 from dotenv import load_dotenv
 import requests
 import json
+import logging
 import time
-from config import sparql, GEONAMES_USERNAME
+import threading
+from config import sparql, GEONAMES_USERNAME, GEONAMES_USERNAMES, GEONAMES_API_URL, GEONAMES_WORKERS, GEONAMES_RATE_PER_HOUR, GEONAMES_INDEX, PAGE_SIZE, MATCH_WORKERS
+from cache_store import SQLiteCache
+from geonames_offline import GeoNamesIndex
+from metrics import metrics
+
+logger = logging.getLogger(__name__)
 
 EARTHQUAKE_MODEL = Namespace("https://crm-eq.ics.forth.gr/ontology#")
 
 
 GEO = Namespace("http://www.w3.org/2003/01/geo/wgs84_pos#")
+GN = Namespace("http://www.geonames.org/ontology#")
+XSD_FLOAT = "http://www.w3.org/2001/XMLSchema#float"
 COORD_THRESHOLD = 1           # km for places matching
 # ------------------ GeoNames Enrichment Functions ------------------
-userName = [GEONAMES_USERNAME]
-cache_file = "geonames_cache.json"
+userName = GEONAMES_USERNAMES or [GEONAMES_USERNAME]
+cache_db = "geonames_cache.sqlite"
+cache_file = "geonames_cache.json"  # legacy whole-file cache, imported into cache_db on first use
+_cache = None
 # ------------------ Cache functions ------------------
 def load_cache():
-    """Load the GeoNames cache from a JSON file."""
-    if os.path.exists(cache_file):
-        with open(cache_file, "r", encoding="utf-8") as f:
-            return json.load(f)
-    return {}
-
-def save_cache(cache):
-    with open(cache_file, "w", encoding="utf-8") as f:
-        json.dump(cache, f, indent=4)
+    """Open the GeoNames cache once per run, importing the legacy JSON cache the first time."""
+    global _cache
+    if _cache is None:
+        _cache = SQLiteCache(cache_db, table="geonames")
+        if len(_cache) == 0 and os.path.exists(cache_file):
+            imported = _cache.import_json(cache_file)
+            logger.info(f"Imported {imported} entries from {cache_file} into {cache_db}.")
+    return _cache
 
 def get_cached_data(label, lat, lon, cache):
     key = f"{label}_{lat}_{lon}"
@@ -35,64 +45,137 @@ def get_cached_data(label, lat, lon, cache):
 
 def update_cache(label, lat, lon, data, cache):
     key = f"{label}_{lat}_{lon}"
-    cache[key] = data
-    save_cache(cache)
+    cache.put(key, data)
+
+# ------------------ GeoNames Accounts ------------------
+GEONAMES_QUOTA_RESET = 3600   # seconds an exhausted account is left alone
+GEONAMES_LIMIT_STATUS = {18, 19, 20}  # GeoNames status codes for daily/hourly/weekly limit exceeded
 
-def get_geonames_enrichment_data(label, lat=None, lon=None, cache_usage_flag=None, username="sophisid"):
+class GeoNamesAccounts:
+    """
+    Pool of GeoNames accounts, optionally each with its own token-bucket rate limiter (rate_per_hour > 0).
+    acquire() hands out the next account with a free token, skipping accounts that
+    have hit their quota; the caller only sleeps when every account is exhausted.
+    """
+
+    def __init__(self, usernames, rate_per_hour=GEONAMES_RATE_PER_HOUR, burst=GEONAMES_WORKERS):
+        self.usernames = list(usernames)
+        self.buckets = {name: TokenBucket(rate_per_hour / 3600, burst) for name in self.usernames} if rate_per_hour > 0 else {}
+        self.exhausted_until = {name: 0.0 for name in self.usernames}
+        self.next_index = 0
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                available = [name for name in self.usernames if self.exhausted_until[name] <= now]
+                if available:
+                    waits = []
+                    for k in range(len(self.usernames)):
+                        name = self.usernames[(self.next_index + k) % len(self.usernames)]
+                        if name not in available:
+                            continue
+                        wait = self.buckets[name].try_acquire() if name in self.buckets else 0.0
+                        if not wait:
+                            self.next_index = (self.usernames.index(name) + 1) % len(self.usernames)
+                            return name
+                        waits.append(wait)
+                    sleep_for = min(waits)
+                else:
+                    sleep_for = min(self.exhausted_until.values()) - now
+                    logger.warning(f"All GeoNames accounts exhausted. Sleeping for {sleep_for:.0f} seconds...")
+            time.sleep(max(sleep_for, 0))
+
+    def mark_exhausted(self, username):
+        with self.lock:
+            self.exhausted_until[username] = time.monotonic() + GEONAMES_QUOTA_RESET
+        metrics.count("geonames.accounts_exhausted")
+        logger.warning(f"GeoNames account {username} exhausted, rotating to the next account.")
+
+geonames_accounts = GeoNamesAccounts(userName)
+
+def geonames_request(service, params, accounts):
+    """Call a GeoNames JSON service, rotating accounts when one hits its quota."""
+    while True:
+        username = accounts.acquire()
+        with metrics.request("geonames"):
+            response = requests.get(f"{GEONAMES_API_URL}/{service}", params={**params, "username": username}, timeout=5)
+        logger.debug(f"Retrieving GeoNames data for: {response.url}")
+        logger.debug(f"Response status: {response.status_code}")
+        if response.status_code == 402:
+            accounts.mark_exhausted(username)
+            continue
+        data = response.json()
+        if data.get("status", {}).get("value") in GEONAMES_LIMIT_STATUS:
+            accounts.mark_exhausted(username)
+            continue
+        return data
+
+def get_offline_geonames_data(label, lat, lon, index):
+    """Answer a GeoNames enrichment lookup from an offline GeoNamesIndex (nearby place first, then name search)."""
+    if lat and lon:
+        try:
+            with metrics.request("geonames_offline"):
+                enriched = index.nearby(lat, lon)
+            if enriched:
+                logger.debug(f"Enriched data (offline nearby): {enriched}")
+                return enriched
+            logger.debug(f"No offline nearby place for: {lat}, {lon}")
+        except ValueError as e:
+            logger.warning(f"Error retrieving offline nearby GeoNames data: {e}")
+    with metrics.request("geonames_offline"):
+        enriched = index.search(label)
+    if enriched:
+        logger.debug(f"Enriched data (offline search): {enriched}")
+    else:
+        logger.debug(f"No offline GeoNames place named: {label}")
+    return enriched
+
+def get_geonames_enrichment_data(label, lat=None, lon=None, cache_usage_flag=None, accounts=None, index=None):
     """
     Retrieve GeoNames data (as a dict) for enrichment.
     If coordinates are provided, try the nearby service; otherwise use the search service.
+    Requests are spread over the accounts pool (geonames_accounts by default).
+    With an offline GeoNamesIndex, both lookups are answered locally and no request is made.
     """
+    if index is not None:
+        return get_offline_geonames_data(label, lat, lon, index)
     cache = load_cache()
+    accounts = accounts or geonames_accounts
     
     if cache_usage_flag:
         cached_data = get_cached_data(label, lat, lon, cache)
         if cached_data:
-            print("Returning cached data:", cached_data)
+            metrics.count("cache.geonames.hits")
+            logger.debug(f"Returning cached data: {cached_data}")
             return cached_data
+        metrics.count("cache.geonames.misses")
     
     if lat and lon:
-        url = f"http://api.geonames.org/findNearbyPlaceNameJSON?lat={lat}&lng={lon}&username={username}"
-        print(f"Retrieving GeoNames data for: {url}")
         try:
-            response = requests.get(url, timeout=5)
-            print(f"Response status: {response.status_code}")
-            if response.status_code == 402: 
-                print("All geoname user exhausted. Sleeping for 1 hour...")
-                time.sleep(3600) 
-                response = requests.get(url, timeout=5)
-            data = response.json()
+            data = geonames_request("findNearbyPlaceNameJSON", {"lat": lat, "lng": lon}, accounts)
             
             if not data.get("geonames"):
-                print("No geonames returned from nearby service. Response:", data)
+                logger.debug(f"No geonames returned from nearby service. Response: {data}")
                 
             else:
                 enriched = data["geonames"][0]
-                print(f"Enriched data (nearby): {enriched}")
+                logger.debug(f"Enriched data (nearby): {enriched}")
                 return enriched
         except Exception as e:
-            print(f"Error retrieving nearby GeoNames data: {e}")
-    url = f"http://api.geonames.org/searchJSON?q={label}&maxRows=1&username={username}"
-    print(f"Retrieving GeoNames data for: {url}")
+            logger.warning(f"Error retrieving nearby GeoNames data: {e}")
     try:
-        response = requests.get(url, timeout=5)
-        print(f"Response status: {response.status_code}")
-        if response.status_code == 402: 
-            print("All geoname user exhausted. Sleeping for 1 hour...")
-            time.sleep(3600)
-            response = requests.get(url, timeout=5)
-
-        data = response.json()
+        data = geonames_request("searchJSON", {"q": label, "maxRows": 1}, accounts)
         if not data.get("geonames"):
-            print("No geonames returned from search service. Response:", data)
-            flag = True
+            logger.debug(f"No geonames returned from search service. Response: {data}")
         else:
             enriched = data["geonames"][0]
-            print(f"Enriched data (search): {enriched}")
+            logger.debug(f"Enriched data (search): {enriched}")
             update_cache(label, lat, lon, enriched, cache)  
             return enriched
     except Exception as e:
-        print(f"Error retrieving search GeoNames data: {e}")      
+        logger.warning(f"Error retrieving search GeoNames data: {e}")      
 
     return None
 
@@ -104,8 +187,6 @@ def update_place_with_geonames_data(place_uri, geonames_data):
     """
     if not geonames_data:
         return
-    
-    graph_name = "https://crm-eq.ics.forth.gr/ontology#/custom/geonames"
 
     geoname_id = geonames_data.get("geonameId")
     if geoname_id:
@@ -117,32 +198,20 @@ def update_place_with_geonames_data(place_uri, geonames_data):
     lng = geonames_data.get("lng")
     adminName1 = geonames_data.get("adminName1")
     countryName = geonames_data.get("countryName")
-    update_query = f"""
-    PREFIX owl: <http://www.w3.org/2002/07/owl#>
-    PREFIX geo: <http://www.w3.org/2003/01/geo/wgs84_pos#>
-    PREFIX gn: <http://www.geonames.org/ontology#>
-    PREFIX xsd: <http://www.w3.org/2001/XMLSchema#>
-    PREFIX custom: <{EARTHQUAKE_MODEL}/custom/>
-    INSERT DATA {{
-       GRAPH custom:geonames {{
-            <{place_uri}> owl:sameAs <{geonames_uri}> .
-            <{geonames_uri}> gn:geonamesName "{name}" .
-            <{geonames_uri}> geo:lat "{lat}"^^xsd:float .
-            <{geonames_uri}> geo:long "{lng}"^^xsd:float .
-            <{geonames_uri}> gn:parentFeature "{adminName1}" .
-            <{geonames_uri}> gn:countryName "{countryName}" .
-        }}
-    }}
-    """
-    sparql.setQuery(update_query)
-    sparql.setMethod(POST)
-    sparql.query()
+    sparql.insert(custom_graph("geonames"), [
+        f"<{place_uri}> <{OWL_SAME_AS}> <{geonames_uri}> .",
+        literal_triple(geonames_uri, GN.geonamesName, name),
+        literal_triple(geonames_uri, GEO.lat, lat, XSD_FLOAT),
+        literal_triple(geonames_uri, GEO.long, lng, XSD_FLOAT),
+        literal_triple(geonames_uri, GN.parentFeature, adminName1),
+        literal_triple(geonames_uri, GN.countryName, countryName),
+    ])
 
 
 # ------------------ Step 1: Enrichment of Places ------------------
 
-def query_places():
-    """Query local place instances from the endpoint."""
+def query_places(page_size=PAGE_SIZE, on_page=None):
+    """Query local place instances from the endpoint, yielding them page by page."""
     query = """
     PREFIX rdf: <http://www.w3.org/1999/02/22-rdf-syntax-ns#>
     PREFIX rdfs: <http://www.w3.org/2000/01/rdf-schema#>
@@ -161,31 +230,52 @@ def query_places():
       }
     }
     """
-    sparql.setQuery(query)
-    sparql.setMethod("GET")
-    results = sparql.query().convert()
-    places = []
-    for result in results["results"]["bindings"]:
+    for result in paged_select(query, "?p ?label ?lat ?long", page_size, on_page):
         p = result["p"]["value"]
         label = result["label"]["value"]
         lat = result["lat"]["value"] if "lat" in result else None
         lon = result["long"]["value"] if "long" in result else None
-        places.append((p, label, lat, lon))
-    return places
-
-def enrich_places(cache_usage_flag):
-    """Enrich each local place with GeoNames data and update the endpoint."""
-    places = query_places()
-    for (p, label, lat, lon) in places:
-        enrichment = get_geonames_enrichment_data(label, lat, lon, cache_usage_flag)
+        yield (p, label, lat, lon)
+
+def enrich_places(cache_usage_flag, workers=GEONAMES_WORKERS, geonames_index=GEONAMES_INDEX):
+    """
+    Enrich each local place with GeoNames data and update the endpoint.
+    Places are streamed from the endpoint; GeoNames lookups run on a pool of `workers` threads
+    and endpoint updates are made in place order.
+    With geonames_index (a directory built by geonames_offline.py), lookups use the offline index.
+    Places sharing a label and coordinates are looked up once: the lookups are coalesced by that
+    key (the GeoNames cache key) and the result is written for every place of the group.
+    """
+    index = GeoNamesIndex(geonames_index) if geonames_index else None
+    if index is None:
+        load_cache()
+    flight = SingleFlight("geonames")
+    places = 0
+
+    def lookup(place):
+        p, label, lat, lon = place
+        return flight.do((label, lat, lon),
+                         lambda: get_geonames_enrichment_data(label, lat, lon, cache_usage_flag, index=index))
+
+    def write(place, enrichment):
+        nonlocal places
+        places += 1
+        metrics.count("enriched.places" if enrichment else "unenriched.places")
         if enrichment:
-            update_place_with_geonames_data(p, enrichment)
+            update_place_with_geonames_data(place[0], enrichment)
+
+    try:
+        ordered_pipeline(query_places(), lookup, write, workers)
+    finally:
+        if index is not None:
+            index.close()
+    flight.log_ratio(places, "places")
 
 # ------------------ Step 2: Matching of Places ------------------
 
-def query_places_with_geonames():
+def query_places_with_geonames(page_size=PAGE_SIZE, on_page=None):
     """
-    Query places and also retrieve any GeoNames resource linked via owl:sameAs.
+    Query places and also retrieve any GeoNames resource linked via owl:sameAs, yielding them page by page.
     """
     query = """
     PREFIX rdf: <http://www.w3.org/1999/02/22-rdf-syntax-ns#>
@@ -209,67 +299,85 @@ def query_places_with_geonames():
       }
     }
     """
-    sparql.setQuery(query)
-    sparql.setMethod("GET")
-    results = sparql.query().convert()
-    places = []
-    for result in results["results"]["bindings"]:
+    for result in paged_select(query, "?p ?label ?lat ?long ?g", page_size, on_page):
         p = result["p"]["value"]
         label = result["label"]["value"]
         lat = result["lat"]["value"] if "lat" in result else None
         lon = result["long"]["value"] if "long" in result else None
         geonames_uri = result["g"]["value"] if "g" in result else None
-        places.append((p, label, lat, lon, geonames_uri))
-    return places
+        yield (p, label, lat, lon, geonames_uri)
 
-def match_places():
+def score_place_blocks(data, blocks, clusters=None):
     """
-    Match places after enrichment.
-    Two places are considered the same if:
-      - They share the same GeoNames URI, OR
-      - Their effective labels (local label plus GeoNames info) are similar enough, or their coordinates are very close.
+    Apply the place rules to (i, partners) blocks; data is (places, close_pairs).
+    Returns (decisions, compared) where decisions are (p1, p2, link type, rule, message) tuples in block order;
+    messages are only built when debug logging is on.
     """
-    places = query_places_with_geonames()
-    n = len(places)
-    for i in range(n):
+    places, close_pairs = data
+    decisions, decide = collect_decisions(clusters, logger)
+    compared = 0
+
+    for i, partners in blocks:
         p1, label1, lat1, lon1, geo1 = places[i]
         effective_label1 = label1
         if geo1:
             effective_label1 = f"{label1} ({geo1})"
-        for j in range(i+1, n):
+        for j in partners:
             p2, label2, lat2, lon2, geo2 = places[j]
+            if clusters is not None and clusters.connected(p1, p2):
+                continue
             effective_label2 = label2
             if geo2:
                 effective_label2 = f"{label2} ({geo2})"
+            compared += 1
             # If both have a GeoNames URI and they are identical, we consider them the same.
             if geo1 and geo2 and (geo1 == geo2):
-                print(f"Inserting owl:sameAs for places (same GeoNames resource):")
-                print(f"  {p1} ({effective_label1})")
-                print(f"  {p2} ({effective_label2})")
-                insert_same_as(p1, p2, "places")
+                decide(p1, p2, SAME_AS, "same_geonames",
+                       lambda: f"Inserting owl:sameAs for places (same GeoNames resource):\n"
+                               f"  {p1} ({effective_label1})\n"
+                               f"  {p2} ({effective_label2})")
                 continue
 
             label_similarity = fuzz.ratio(effective_label1, effective_label2)
-            coordinate_match = False
-            distance = None
-            if lat1 and lon1 and lat2 and lon2:
-                try:
-                    distance = haversine(float(lat1), float(lon1), float(lat2), float(lon2))
-                    if distance <= COORD_THRESHOLD:
-                        print(f"Distance: {distance:.3f} km")
-                        coordinate_match = True
-                except ValueError:
-                    pass
+            distance = close_pairs.get((i, j))
+            coordinate_match = distance is not None
 
             if label_similarity >= 95 or coordinate_match:
                 if coordinate_match and distance is not None:
-                    print(f"Inserting owl:sameAs for places (coordinate match):")
-                    print(f"  {p1} ({effective_label1}, lat:{lat1}, lon:{lon1})")
-                    print(f"  {p2} ({effective_label2}, lat:{lat2}, lon:{lon2})")
-                    print(f"  Distance: {distance:.3f} km")
+                    rule = "coordinate_match"
+                    message = lambda: (f"Inserting owl:sameAs for places (coordinate match):\n"
+                                       f"  {p1} ({effective_label1}, lat:{lat1}, lon:{lon1})\n"
+                                       f"  {p2} ({effective_label2}, lat:{lat2}, lon:{lon2})\n"
+                                       f"  Distance: {distance:.3f} km")
                 else:
-                    print(f"Inserting owl:sameAs for places (label match):")
-                    print(f"  {p1} ({effective_label1})")
-                    print(f"  {p2} ({effective_label2})")
-                    print(f"  Label similarity: {label_similarity}%")
-                insert_same_as(p1, p2, "places")
+                    rule = "label_match"
+                    message = lambda: (f"Inserting owl:sameAs for places (label match):\n"
+                                       f"  {p1} ({effective_label1})\n"
+                                       f"  {p2} ({effective_label2})\n"
+                                       f"  Label similarity: {label_similarity}%")
+                decide(p1, p2, SAME_AS, rule, message)
+    return decisions, compared
+
+def match_places(incremental=False, workers=MATCH_WORKERS, link_mode="clique"):
+    """
+    Match places after enrichment.
+    Two places are considered the same if:
+      - They share the same GeoNames URI, OR
+      - Their effective labels (local label plus GeoNames info) are similar enough, or their coordinates are very close.
+    Returns the number of pairs compared.
+    """
+    places = list(query_places_with_geonames())
+    n = len(places)
+    lats = parse_coordinates([lat for (_, _, lat, _, _) in places])
+    lons = parse_coordinates([lon for (_, _, _, lon, _) in places])
+    close_pairs = GridIndex(lats, lons, COORD_THRESHOLD).pairs_within(COORD_THRESHOLD)
+    snapshot = MatchSnapshot("places")
+    blocks = all_partners(n)
+    if incremental:
+        changed = snapshot.changed(places)
+        logger.info(f"Incremental run: {len(changed)} of {n} place rows are new or changed.")
+        blocks = incremental_partners(blocks, changed)
+    compared = write_matches("places", score_place_blocks, (places, close_pairs), blocks, workers, link_mode, snapshot, places)
+    snapshot.close()
+    logger.info(f"Compared {compared} of {n * (n - 1) // 2} place pairs.")
+    return compared
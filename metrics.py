@@ -0,0 +1,141 @@
+# ------------------ Run Metrics ------------------
+
+import bisect
+import json
+import logging
+import threading
+import time
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)  # upper bounds in seconds
+
+class Histogram:
+    """Latency histogram with fixed LATENCY_BUCKETS upper bounds (plus an overflow bucket)."""
+
+    def __init__(self):
+        self.counts = [0] * (len(LATENCY_BUCKETS) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def observe(self, seconds):
+        self.counts[bisect.bisect_left(LATENCY_BUCKETS, seconds)] += 1
+        self.count += 1
+        self.total += seconds
+        self.max = max(self.max, seconds)
+
+    def quantile(self, q):
+        """Upper bound of the bucket holding the q-quantile (the maximum for the overflow bucket)."""
+        rank = q * self.count
+        seen = 0
+        for bound, count in zip(LATENCY_BUCKETS, self.counts):
+            seen += count
+            if count and seen >= rank:
+                return bound
+        return self.max
+
+    def to_dict(self):
+        buckets = {f"le_{bound}": count for bound, count in zip(LATENCY_BUCKETS, self.counts) if count}
+        if self.counts[-1]:
+            buckets["le_inf"] = self.counts[-1]
+        return {
+            "count": self.count,
+            "total_seconds": round(self.total, 4),
+            "mean_seconds": round(self.total / self.count, 4) if self.count else None,
+            "p50_seconds": self.quantile(0.5) if self.count else None,
+            "p95_seconds": self.quantile(0.95) if self.count else None,
+            "max_seconds": round(self.max, 4),
+            "buckets": buckets,
+        }
+
+class Metrics:
+    """
+    Counters, stage timers and latency histograms of a run, shared by all threads.
+    Counter names are dotted, e.g. "pairs_compared.places", "rules.persons.date_match",
+    "links.earthquakes", "cache.geonames.hits" and "requests.wikidata".
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.counters = {}
+            self.stages = {}
+            self.timeline = []
+            self.latency = {}
+            self.started = time.perf_counter()
+
+    def count(self, name, n=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + n
+
+    def observe(self, name, seconds):
+        with self.lock:
+            self.latency.setdefault(name, Histogram()).observe(seconds)
+
+    @contextmanager
+    def stage(self, name):
+        """
+        Time a pipeline stage; repeated stages of the same name add up. Every run is also added to
+        the timeline as (start, end) seconds since the metrics were reset.
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            end = time.perf_counter()
+            seconds = end - start
+            with self.lock:
+                self.stages[name] = self.stages.get(name, 0.0) + seconds
+                self.timeline.append({"stage": name, "start": round(start - self.started, 4),
+                                      "end": round(end - self.started, 4)})
+            logger.info(f"Stage {name} finished in {seconds:.2f} s.")
+
+    @contextmanager
+    def request(self, service):
+        """Count a call to an external service and record its latency; failed calls are also counted as errors."""
+        start = time.perf_counter()
+        try:
+            yield
+        except Exception:
+            self.count(f"requests.{service}.errors")
+            raise
+        finally:
+            self.observe(service, time.perf_counter() - start)
+            self.count(f"requests.{service}")
+
+    def snapshot(self):
+        with self.lock:
+            return {
+                "stages": {name: round(seconds, 4) for name, seconds in self.stages.items()},
+                "timeline": sorted(self.timeline, key=lambda entry: entry["start"]),
+                "counters": dict(sorted(self.counters.items())),
+                "latency": {name: histogram.to_dict() for name, histogram in sorted(self.latency.items())},
+            }
+
+    def log_timeline(self, width=40):
+        """Log the stage timeline as one bar per stage run, scaled to the span of all stages."""
+        snapshot = self.snapshot()
+        timeline = snapshot["timeline"]
+        if not timeline:
+            return
+        origin = timeline[0]["start"]
+        span = max(entry["end"] for entry in timeline) - origin or 1
+        name_width = max(len(entry["stage"]) for entry in timeline)
+        logger.info(f"Stage timeline ({span:.2f} s wall clock, {sum(snapshot['stages'].values()):.2f} s of stages):")
+        for entry in timeline:
+            begin = min(width - 1, round((entry["start"] - origin) / span * width))
+            length = min(width - begin, max(1, round((entry["end"] - entry["start"]) / span * width)))
+            logger.info(f"  {entry['stage']:<{name_width}} |{' ' * begin}{'#' * length:<{width - begin}}| "
+                        f"{entry['start'] - origin:7.2f} s - {entry['end'] - origin:7.2f} s")
+
+    def dump(self, path):
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump(self.snapshot(), f, indent=2)
+            f.write("\n")
+
+metrics = Metrics()
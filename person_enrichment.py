@@ -1,6 +1,17 @@
 
 import re
+import logging
 import requests
+from cache_store import SQLiteCache
+from config import WIKIDATA_ENDPOINT, WIKIDATA_CACHE_TTL_DAYS, WIKIDATA_BATCH_SIZE, WIKIDATA_TIMEOUT
+from metrics import metrics
+from utils import sparql_string, SingleFlight
+from date_parsing import extract_year
+
+logger = logging.getLogger(__name__)
+
+cache_db = "wikidata_cache.sqlite"
+_cache = None
 
 # ------------------  wikidata Enrichment Functions ------------------
 
@@ -10,33 +21,134 @@ def extract_xsd_date(raw_date):
         return None
     return raw_date.lstrip('+').split('T')[0]  # Remove leading '+' and time portion
 
-def query_wikidata(query):
-    """Execute a SPARQL query against Wikidata."""
-    url = "https://query.wikidata.org/sparql"
+def fetch_wikidata(query):
+    """Execute a SPARQL query against Wikidata; returns the result bindings, or None on error."""
     headers = {"User-Agent": "MyWikidataBot/1.0"}
-    response = requests.get(url, headers=headers, params={"query": query, "format": "json"})
+    try:
+        with metrics.request("wikidata"):
+            response = requests.get(WIKIDATA_ENDPOINT, headers=headers, params={"query": query, "format": "json"},
+                                    timeout=WIKIDATA_TIMEOUT)
+    except requests.Timeout:
+        metrics.count("requests.wikidata.errors")
+        logger.warning(f"Timed out fetching data for query: {query}")
+        return None
 
     if response.status_code != 200:
-        print(f"Error fetching data for query: {query}")
-        return []
+        metrics.count("requests.wikidata.errors")
+        logger.warning(f"Error fetching data for query: {query}")
+        return None
 
     return response.json().get("results", {}).get("bindings", [])
 
-def extract_year(date_string):
-    match = re.search(r'(\d{4})', date_string)
-    if match:
-        return int(match.group(1))
-    return None
+def load_cache():
+    """Open the Wikidata cache once per run."""
+    global _cache
+    if _cache is None:
+        ttl = WIKIDATA_CACHE_TTL_DAYS * 86400 if WIKIDATA_CACHE_TTL_DAYS > 0 else None
+        _cache = SQLiteCache(cache_db, table="wikidata", ttl=ttl)
+    return _cache
 
-def get_wikidata_enrichment_data(name, birth_date=None, death_date=None, cache_usage_flag=False):
-    cleaned_name = re.sub(r"\s*\(.*?\)", "", name).strip()
-    probable_occupations = {
-        "historian": 5, "archaeologist": 4, "geographer": 4, "seismologist": 5, "geologist": 5,
-        "scholar": 3, "scientist": 3, "chronicler": 4, "writer": 2, "author": 2,
-        "researcher": 3, "academic": 3, "educator": 2, "professor": 2, "teacher": 1,
-    }
+PROBABLE_OCCUPATIONS = {
+    "historian": 5, "archaeologist": 4, "geographer": 4, "seismologist": 5, "geologist": 5,
+    "scholar": 3, "scientist": 3, "chronicler": 4, "writer": 2, "author": 2,
+    "researcher": 3, "academic": 3, "educator": 2, "professor": 2, "teacher": 1,
+}
 
-    
+def label_query(names):
+    """Wikidata query for humans whose English label is one of names."""
+    values = " ".join(f"{sparql_string(name)}@en" for name in names)
+    return f"""
+    SELECT ?name ?person ?personLabel ?birthDate ?deathDate ?occupationLabel WHERE {{
+      VALUES ?name {{ {values} }}
+      ?person wdt:P31 wd:Q5;
+              rdfs:label ?name.
+      OPTIONAL {{ ?person wdt:P569 ?birthDate. }} 
+      OPTIONAL {{ ?person wdt:P570 ?deathDate. }}
+      OPTIONAL {{ ?person wdt:P106 ?occupation. }}
+      SERVICE wikibase:label {{ bd:serviceParam wikibase:language "en". }}
+    }}
+    """
+
+def family_name_query(names):
+    """Wikidata query for humans whose family name (P734) has one of names as English label."""
+    values = " ".join(f"{sparql_string(name)}@en" for name in names)
+    return f"""
+    SELECT ?name ?person ?personLabel ?birthDate ?deathDate ?occupationLabel WHERE {{
+      VALUES ?name {{ {values} }}
+      ?person wdt:P31 wd:Q5;
+              wdt:P734 ?familyName.  # Family name property
+      ?familyName rdfs:label ?name.
+      OPTIONAL {{ ?person wdt:P569 ?birthDate. }} 
+      OPTIONAL {{ ?person wdt:P570 ?deathDate. }}
+      OPTIONAL {{ ?person wdt:P106 ?occupation. }}  
+      SERVICE wikibase:label {{ bd:serviceParam wikibase:language "en". }}
+    }}
+    """
+
+WIKIDATA_QUERIES = {"label": label_query, "family_name": family_name_query}
+
+def fetch_wikidata_batch(variant, names, cache_usage_flag=False, chunk_size=WIKIDATA_BATCH_SIZE, flight=None, index=None):
+    """
+    Resolve many names with one VALUES query per chunk of chunk_size names.
+    variant is "label" or "family_name". Returns {name: bindings}; the raw bindings of
+    every name are stored in the persistent cache and reused when cache_usage_flag is set.
+    With a SingleFlight shared by concurrent batches, a name another batch has already claimed
+    is not fetched again: this batch resolves the names it claimed first, then waits for the others.
+    With an offline WikidataIndex, names are looked up locally and no request is made.
+    """
+    cache = load_cache() if index is None else None
+    flight = flight or SingleFlight("wikidata")
+    owned = {}
+    claimed = {}
+    for name in dict.fromkeys(names):
+        future, leader = flight.claim(f"{variant}:{name}")
+        (owned if leader else claimed)[name] = future
+
+    results = {}
+    try:
+        missing = []
+        for name in owned:
+            if index is not None:
+                with metrics.request("wikidata_offline"):
+                    results[name] = index.lookup(variant, name)
+                continue
+            cached = cache.get(f"{variant}:{name}") if cache_usage_flag else None
+            if cached is not None:
+                results[name] = cached
+            else:
+                missing.append(name)
+        if cache_usage_flag and index is None:
+            metrics.count("cache.wikidata.hits", len(results))
+            metrics.count("cache.wikidata.misses", len(missing))
+        if results:
+            logger.debug(f"-Returning cached Wikidata {variant} results for {len(results)} names")
+
+        for start in range(0, len(missing), max(1, chunk_size)):
+            chunk = missing[start:start + max(1, chunk_size)]
+            bindings = fetch_wikidata(WIKIDATA_QUERIES[variant](chunk))
+            if bindings is None:
+                continue
+            per_name = {name: [] for name in chunk}
+            for binding in bindings:
+                name = binding.pop("name", {}).get("value")
+                if name in per_name:
+                    per_name[name].append(binding)
+            for name, name_bindings in per_name.items():
+                cache.put(f"{variant}:{name}", name_bindings)
+                results[name] = name_bindings
+    except Exception as e:
+        for future in owned.values():
+            future.set_exception(e)
+        raise
+    for name, future in owned.items():
+        future.set_result(results.get(name, []))
+    for name, future in claimed.items():
+        results[name] = future.result()
+    return {name: results.get(name, []) for name in names}
+
+def prepare_name(name, birth_date=None, death_date=None):
+    """Strip parenthesised parts from a name; a parenthesised year is taken as birth/death date."""
+    cleaned_name = re.sub(r"\s*\(.*?\)", "", name).strip()
     #assuming that data in parenthesis is birth or death date
     date_match = re.search(r"\((\d{4})\)", name)
     if date_match: 
@@ -46,185 +158,115 @@ def get_wikidata_enrichment_data(name, birth_date=None, death_date=None, cache_u
             birth_date = year
             death_date = year
         cleaned_name = cleaned_name.replace(date_match.group(0), "").strip()
-        print(f"-Date found in name assuming birth or death day: {birth_date} - {death_date}")
+        logger.debug(f"-Date found in name assuming birth or death day: {birth_date} - {death_date}")
+    return cleaned_name, birth_date, death_date
 
+def score_wikidata_results(results, birth_date, death_date, best_match=None, best_match_score=0, occupations=()):
+    """
+    Score Wikidata bindings by occupation weights and birth/death year agreement.
+    Returns the updated (best_match, best_match_score, occupations).
+    """
+    occupations = list(occupations)
+    occupations_set = set()
+    id_bucket = []
+    for result in results:
+        id = result.get("person", {}).get("value", "")
+        if id in id_bucket:
+            if "occupationLabel" in result:
+                occupations_set.add(result["occupationLabel"]["value"])
+        else:
+            id_bucket.append(id)
+            occupations_set = set()
+            if "occupationLabel" in result:
+                occupations_set.add(result["occupationLabel"]["value"])
+        match_score = sum(PROBABLE_OCCUPATIONS.get(occupation.lower(), 0) for occupation in occupations_set)
+    
+        birth_date_match = False
+        death_date_match = False
+        if "birthDate" in result and birth_date:
+            birth_date_match = extract_year(result["birthDate"]["value"]) == extract_year(birth_date)
+        if "deathDate" in result and death_date:
+            death_date_match = extract_year(result["deathDate"]["value"]) == extract_year(death_date)
+        
+        # Increment match score for date matches
+        if birth_date_match:
+            match_score += 5
+        if death_date_match:
+            match_score += 5
+        
+        if match_score > best_match_score or match_score == best_match_score and len(occupations_set) > len(occupations):
+            best_match = result
+            best_match_score = match_score
+            occupations = list(occupations_set)
+    return best_match, best_match_score, occupations
 
-    query = f"""
-    SELECT ?person ?personLabel ?birthDate ?deathDate ?occupationLabel WHERE {{
-      ?person wdt:P31 wd:Q5;
-              rdfs:label "{cleaned_name}"@en.
-      OPTIONAL {{ ?person wdt:P569 ?birthDate. }} 
-      OPTIONAL {{ ?person wdt:P570 ?deathDate. }}
-      OPTIONAL {{ ?person wdt:P106 ?occupation. }}
-      SERVICE wikibase:label {{ bd:serviceParam wikibase:language "en". }}
-    }}
+def get_wikidata_enrichment_data_batch(persons, cache_usage_flag=False, flight=None, index=None):
     """
+    Enrich many persons at once. persons is a list of (name, birth_date, death_date).
+    Each lookup strategy (exact label, whole name as family name, last word as family name)
+    is resolved for all pending names with batched VALUES queries, coalesced through flight if given,
+    or from an offline WikidataIndex (wikidata_offline.py).
+    Returns one enrichment dict per person, in input order ({} when nothing relevant was found).
+    """
+    prepared = [prepare_name(name, birth_date, death_date) for (name, birth_date, death_date) in persons]
+    cleaned_names = [cleaned_name for (cleaned_name, _, _) in prepared]
+    last_names = [cleaned_name.split()[-1] if cleaned_name.split() else "" for cleaned_name in cleaned_names]
 
-    results = query_wikidata(query)
+    label_results = fetch_wikidata_batch("label", cleaned_names, cache_usage_flag, flight=flight, index=index)
+    best = []
+    for (cleaned_name, birth_date, death_date) in prepared:
+        results = label_results[cleaned_name]
+        logger.debug(f"-[Name]: {cleaned_name} -> {len(results)} results found.")
+        best.append(score_wikidata_results(results, birth_date, death_date))
 
-    best_match = None
-    best_match_score = 0
-    
-    occupations = []
-    print(f"-[Name]: {cleaned_name} -> {len(results)} results found.")
-    if results:
-        occupations_set = set()
-        id_bucket = []
-        for result in results:
-            id = result.get("person", {}).get("value", "")
-            if id in id_bucket:
-                if "occupationLabel" in result:
-                    occupations_set.add(result["occupationLabel"]["value"])
-            else:
-                id_bucket.append(id)
-                occupations_set = set()
-                if "occupationLabel" in result:
-                    occupations_set.add(result["occupationLabel"]["value"])
-            match_score = sum(probable_occupations.get(occupation.lower(), 0) for occupation in occupations_set)
-        
-            birth_date_match = False
-            death_date_match = False
-            if "birthDate" in result and birth_date:
-                birth_date_match = extract_year(result["birthDate"]["value"]) == extract_year(birth_date)
-            if "deathDate" in result and death_date:
-                death_date_match = extract_year(result["deathDate"]["value"]) == extract_year(death_date)
-            
-            # Increment match score for date matches
-            if birth_date_match:
-                match_score += 5
-            if death_date_match:
-                match_score += 5
-            
-            if match_score > best_match_score or match_score == best_match_score and len(occupations_set) > len(occupations):
-                best_match = result
-                best_match_score = match_score
-                occupations = list(occupations_set)
-                
+    def needs_fallback(k):
+        best_match, best_match_score, _ = best[k]
+        return not label_results[cleaned_names[k]] or best_match_score == 0 or not best_match
 
     #[Case 1] Search by family name = whole name if no relevant occupations found 
-    if not results or best_match_score == 0 or not best_match:
-        print(f"--Trying family name search with whole name string being the last name...")
-        whole_name_query = f"""
-        SELECT ?person ?personLabel ?birthDate ?deathDate ?occupationLabel WHERE {{
-          ?person wdt:P31 wd:Q5;
-                  wdt:P734 ?familyName.  # Family name property
-          ?familyName rdfs:label "{cleaned_name}"@en.
-          OPTIONAL {{ ?person wdt:P569 ?birthDate. }} 
-          OPTIONAL {{ ?person wdt:P570 ?deathDate. }}
-          OPTIONAL {{ ?person wdt:P106 ?occupation. }}  
-          SERVICE wikibase:label {{ bd:serviceParam wikibase:language "en". }}
-        }}
-        """
-        family_name_results = query_wikidata(whole_name_query)
-        print(f"--[Family Name]: {cleaned_name} -> {len(family_name_results)} results found.")
-        if family_name_results:
-            occupations_set = set()
-            id_bucket = []
-            for result in family_name_results:
-                id = result.get("person", {}).get("value", "")
-                if id in id_bucket:
-                    if "occupationLabel" in result:
-                        occupations_set.add(result["occupationLabel"]["value"])
-                else:
-                    id_bucket.append(id)
-                    occupations_set = set()
-                    if "occupationLabel" in result:
-                        occupations_set.add(result["occupationLabel"]["value"])
-                match_score = sum(probable_occupations.get(occupation.lower(), 0) for occupation in occupations_set)
-
-                # Check birth and death dates
-                birth_date_match = False
-                death_date_match = False
-                if "birthDate" in result and birth_date:
-                    birth_date_match = extract_year(result["birthDate"]["value"]) == extract_year(birth_date)
-                if "deathDate" in result and death_date:
-                    death_date_match = extract_year(result["deathDate"]["value"]) == extract_year(death_date)
-                # Increment match score for date matches
-                if birth_date_match:
-                    match_score += 5
-                if death_date_match:
-                    match_score += 5
-
-                if match_score > best_match_score or match_score == best_match_score and len(occupations_set) > len(occupations):
-                    best_match = result
-                    best_match_score = match_score
-                    occupations = list(occupations_set)
+    pending = [k for k in range(len(persons)) if needs_fallback(k)]
+    family_name_results = fetch_wikidata_batch("family_name", [cleaned_names[k] for k in pending], cache_usage_flag, flight=flight, index=index)
+    for k in pending:
+        cleaned_name, birth_date, death_date = prepared[k]
+        results = family_name_results[cleaned_name]
+        logger.debug(f"--[Family Name]: {cleaned_name} -> {len(results)} results found.")
+        best[k] = score_wikidata_results(results, birth_date, death_date, *best[k])
 
     #[Case 2] Search by family name = last name if no results in case 1
-    if not results or best_match_score == 0 or not best_match:
-        
-        last_name = cleaned_name.split()[-1]  # Assuming last word is the last name
-        print(f"--Trying family name search assuming last word in Name string is the last name...")
-        
-        if last_name:
-            last_name_query = f"""
-            SELECT ?person ?personLabel ?birthDate ?deathDate ?occupationLabel WHERE {{
-              ?person wdt:P31 wd:Q5;
-                      wdt:P734 ?familyName.  # Family name property
-              ?familyName rdfs:label "{last_name}"@en.
-              OPTIONAL {{ ?person wdt:P569 ?birthDate. }} 
-              OPTIONAL {{ ?person wdt:P570 ?deathDate. }}
-              OPTIONAL {{ ?person wdt:P106 ?occupation. }}  
-              SERVICE wikibase:label {{ bd:serviceParam wikibase:language "en". }}
-            }}
-            """
-            family_name_results = query_wikidata(last_name_query)
-            print(f"--[Family Name]: {cleaned_name} -> {len(family_name_results)} results found.")
-            if family_name_results:
-                occupations_set = set()
-                id_bucket = []
-                for result in family_name_results:
-                    id = result.get("person", {}).get("value", "")
-                    if id in id_bucket:
-                        if "occupationLabel" in result:
-                            occupations_set.add(result["occupationLabel"]["value"])
-                    else:
-                        
-                        id_bucket.append(id)
-                        occupations_set = set()
-                        if "occupationLabel" in result:
-                            occupations_set.add(result["occupationLabel"]["value"])
-                      
-                    match_score = sum(probable_occupations.get(occupation.lower(), 0) for occupation in occupations_set)
-                    
-                    birth_date_match = False
-                    death_date_match = False
-                    if "birthDate" in result and birth_date:
-                        birth_date_match = extract_year(result["birthDate"]["value"]) == extract_year(birth_date)
-                    if "deathDate" in result and death_date:
-                        death_date_match = extract_year(result["deathDate"]["value"]) == extract_year(death_date)
-                    if birth_date_match:
-                        match_score += 5
-                    if death_date_match:
-                        match_score += 5
-                    if match_score > best_match_score or match_score == best_match_score and len(occupations_set) > len(occupations):
-                        best_match = result
-                        best_match_score = match_score
-                        occupations = list(occupations_set)
-
-        
+    pending = [k for k in range(len(persons)) if needs_fallback(k) and last_names[k]]
+    last_name_results = fetch_wikidata_batch("family_name", [last_names[k] for k in pending], cache_usage_flag, flight=flight, index=index)
+    for k in pending:
+        cleaned_name, birth_date, death_date = prepared[k]
+        results = last_name_results[last_names[k]]
+        logger.debug(f"--[Family Name]: {cleaned_name} -> {len(results)} results found.")
+        best[k] = score_wikidata_results(results, birth_date, death_date, *best[k])
 
-            
+    enrichments = []
+    for k, (best_match, best_match_score, occupations) in enumerate(best):
+        cleaned_name = cleaned_names[k]
+        if not best_match or best_match_score == 0:
+            logger.debug(f"--No relevant occupations found for {cleaned_name} or {last_names[k]}. Skipping enrichment.")
+            enrichments.append({})
+            continue
 
-    if not best_match or best_match_score == 0:
-        print(f"--No relevant occupations found for {cleaned_name} or {last_name}. Skipping enrichment.")
-        return {}
+        person_uri = best_match["person"]["value"].split("/")[-1]  
+        label = best_match.get("personLabel", {}).get("value", cleaned_name)
+        birth_date = best_match["birthDate"]["value"] if "birthDate" in best_match else None
+        death_date = best_match["deathDate"]["value"] if "deathDate" in best_match else None
 
-    person_uri = best_match["person"]["value"].split("/")[-1]  
-    label = best_match.get("personLabel", {}).get("value", cleaned_name)
-    birth_date = best_match["birthDate"]["value"] if "birthDate" in best_match else None
-    death_date = best_match["deathDate"]["value"] if "deathDate" in best_match else None
+        enrichments.append({
+            "person": person_uri,
+            "label": label,
+            "birthDate": birth_date,
+            "deathDate": death_date,
+            "occupations":  occupations, 
+            "bestMatchScore": best_match_score,
+        })
+    return enrichments
 
-    
-    return {
-        "person": person_uri,
-        "label": label,
-        "birthDate": birth_date,
-        "deathDate": death_date,
-        "occupations":  occupations, 
-        "bestMatchScore": best_match_score,
-        
-    }
+def get_wikidata_enrichment_data(name, birth_date=None, death_date=None, cache_usage_flag=False, index=None):
+    """Enrich a single person; see get_wikidata_enrichment_data_batch."""
+    return get_wikidata_enrichment_data_batch([(name, birth_date, death_date)], cache_usage_flag, index=index)[0]
 
 # def update_person_with_wikidata_data(person_uri, wikidata_data):
 #     """
@@ -3,21 +3,31 @@ from SPARQLWrapper import SPARQLWrapper, JSON, POST , URLENCODED
 from fuzzywuzzy import fuzz
 from dotenv import load_dotenv
 import os
+import re
 import argparse
+import logging
 
-from person_enrichment import get_wikidata_enrichment_data
-from utils import insert_same_as, insert_close_match
+from person_enrichment import get_wikidata_enrichment_data, get_wikidata_enrichment_data_batch
+from utils import custom_graph, literal_triple, CUSTOM_CLOSE_MATCH, write_matches, MatchSnapshot, SAME_AS, CLOSE_MATCH, ordered_pipeline, all_partners, candidate_partners, incremental_partners, paged_select, chunked, SingleFlight, collect_decisions
 from match_eq import match_earthquakes, normalize_dates
-from config import sparql, GEONAMES_USERNAME
+from wikidata_offline import WikidataIndex
+from config import sparql, GEONAMES_USERNAME, WIKIDATA_BATCH_SIZE, WIKIDATA_CONCURRENCY, WIKIDATA_INDEX, PAGE_SIZE, MATCH_WORKERS
+from metrics import metrics
+
+logger = logging.getLogger(__name__)
 
 
 # Namespaces
 EARTHQUAKE_MODEL = Namespace("https://crm-eq.ics.forth.gr/ontology#")
 DATE_THRESHOLD = 2            # years allowable difference for persons
+RDFS_LABEL = "http://www.w3.org/2000/01/rdf-schema#label"
+WIKIDATA_PROP = "http://www.wikidata.org/prop/direct/"
+XSD_DATE = "http://www.w3.org/2001/XMLSchema#date"
 
 # ------------------ Matching Persons ------------------
 
-def query_persons():
+def query_persons(page_size=PAGE_SIZE, on_page=None):
+    """Query local persons from the endpoint, yielding them page by page."""
     query = """
     PREFIX rdf: <http://www.w3.org/1999/02/22-rdf-syntax-ns#>
     PREFIX rdfs: <http://www.w3.org/2000/01/rdf-schema#>
@@ -29,21 +39,17 @@ def query_persons():
       OPTIONAL { ?p <https://crm-eq.ics.forth.gr/ontology#P100i_died_in> ?death . }
     }
     """
-    sparql.setQuery(query)
-    sparql.setMethod("GET")
-    results = sparql.query().convert()
-    persons = []
-    for result in results["results"]["bindings"]:
+    for result in paged_select(query, "?p ?label ?birth ?death", page_size, on_page):
         p = result["p"]["value"]
         label = result["label"]["value"]
         birth = result.get("birth", {}).get("value", None)
         death = result.get("death", {}).get("value", None)
-        persons.append((p, label, birth, death))
-    return persons
+        yield (p, label, birth, death)
 
-def query_persons_with_wikidata():
+def query_persons_with_wikidata(page_size=PAGE_SIZE, on_page=None):
     """
     Query persons and retrieve any Wikidata resource linked via custom:closeMatch, ensuring distinct results.
+    Persons are yielded page by page.
     """
     query = """
     PREFIX rdf: <http://www.w3.org/1999/02/22-rdf-syntax-ns#>
@@ -60,19 +66,14 @@ def query_persons_with_wikidata():
       }
     }
     """
-    sparql.setQuery(query)
-    sparql.setMethod("GET")
-    results = sparql.query().convert()
-    persons = []
-    for result in results["results"]["bindings"]:
+    for result in paged_select(query, "?p ?label ?birth ?death ?w", page_size, on_page):
         p = result["p"]["value"]
         label = result["label"]["value"]
         birth = result.get("birth", {}).get("value", None)
         death = result.get("death", {}).get("value", None)
         wikidata_uri = result["w"]["value"] if "w" in result else None
-        persons.append((p, label, birth, death, wikidata_uri))
+        yield (p, label, birth, death, wikidata_uri)
         # print(f"Person: {p}, Label: {label}, Birth: {birth}, Death: {death}, Wikidata: {wikidata_uri}")
-    return persons
 
 def update_person_with_wikidata_data(person_uri, wikidata_data):
     """
@@ -82,8 +83,6 @@ def update_person_with_wikidata_data(person_uri, wikidata_data):
     """
     if not wikidata_data:
         return
- 
-    graph_name = "https://crm-eq.ics.forth.gr/ontology#/custom/wikidata"
 
     wikidata_uri = f"http://www.wikidata.org/entity/{wikidata_data['person']}"
     name = wikidata_data.get("label")
@@ -91,39 +90,53 @@ def update_person_with_wikidata_data(person_uri, wikidata_data):
     death_date = wikidata_data.get("deathDate")
     occupations = wikidata_data.get("occupations", [])
 
-    update_query = f"""
-    PREFIX owl: <http://www.w3.org/2002/07/owl#>
-    PREFIX xsd: <http://www.w3.org/2001/XMLSchema#>
-    PREFIX custom: <{EARTHQUAKE_MODEL}/custom/>
-    
-    INSERT DATA {{
-       GRAPH custom:wikidata {{
-            <{person_uri}> custom:closeMatch <{wikidata_uri}> .
-            <{wikidata_uri}> rdfs:label "{name}" .
-            {f'<{wikidata_uri}> <http://www.wikidata.org/prop/direct/P569> "{birth_date}"^^xsd:date .' if birth_date else ''}
-            {f'<{wikidata_uri}> <http://www.wikidata.org/prop/direct/P570> "{death_date}"^^xsd:date .' if death_date else ''}
-            {" ".join([f'<{wikidata_uri}> <http://www.wikidata.org/prop/direct/P106> "{occupation}" .' for occupation in occupations])}
-        }}
-    }}
-    """
-    sparql.setQuery(update_query)
-    sparql.setMethod(POST)
+    triples = [f"<{person_uri}> <{CUSTOM_CLOSE_MATCH}> <{wikidata_uri}> .",
+               literal_triple(wikidata_uri, RDFS_LABEL, name)]
+    if birth_date:
+        triples.append(literal_triple(wikidata_uri, f"{WIKIDATA_PROP}P569", birth_date, XSD_DATE))
+    if death_date:
+        triples.append(literal_triple(wikidata_uri, f"{WIKIDATA_PROP}P570", death_date, XSD_DATE))
+    triples.extend(literal_triple(wikidata_uri, f"{WIKIDATA_PROP}P106", occupation) for occupation in occupations)
     try:
-        response = sparql.query()
-        print(f"Updated {person_uri} with Wikidata data")
+        sparql.insert(custom_graph("wikidata"), triples)
+        logger.debug(f"Updated {person_uri} with Wikidata data")
     except Exception as e:
-        print(f"Error updating {person_uri} with Wikidata data: {e}")
+        logger.warning(f"Error updating {person_uri} with Wikidata data: {e}")
     
-def enrich_persons(cache_usage_flag):
-    """Enrich each local person Wikidata data and update the endpoint."""
-    persons = query_persons()
-    for (p, name, birth_date, death_date) in persons:
+def enrich_persons(cache_usage_flag, concurrency=WIKIDATA_CONCURRENCY, wikidata_index=WIKIDATA_INDEX):
+    """
+    Enrich each local person Wikidata data and update the endpoint.
+    Chunks of WIKIDATA_BATCH_SIZE persons are fetched and scored by `concurrency` threads
+    while a writer thread updates the endpoint, so Wikidata and endpoint latency overlap.
+    Persons are streamed from the endpoint and updates are written in person order.
+    Every distinct name is looked up once per run, even when it is shared by persons of chunks
+    fetched at the same time; the bindings are scored for each person carrying the name.
+    With wikidata_index (a file built by wikidata_offline.py), names are resolved from the offline index.
+    """
+    index = WikidataIndex(wikidata_index) if wikidata_index else None
+    chunks = chunked(query_persons(), WIKIDATA_BATCH_SIZE)
+    flight = SingleFlight("wikidata")
+    persons = 0
+
+    def fetch_and_score(chunk):
+        return get_wikidata_enrichment_data_batch(
+            [(name, birth_date, death_date) for (p, name, birth_date, death_date) in chunk], cache_usage_flag, flight, index)
 
-        wikidata_data = get_wikidata_enrichment_data(name, birth_date, death_date, cache_usage_flag)
-        print(f"---Enriched data (Wikidata): {wikidata_data}")
-        
-        if wikidata_data:
-            update_person_with_wikidata_data(p, wikidata_data)
+    def write(chunk, enrichments):
+        nonlocal persons
+        persons += len(chunk)
+        for (p, name, birth_date, death_date), wikidata_data in zip(chunk, enrichments):
+            logger.debug(f"---Enriched data (Wikidata): {wikidata_data}")
+            metrics.count("enriched.persons" if wikidata_data else "unenriched.persons")
+            if wikidata_data:
+                update_person_with_wikidata_data(p, wikidata_data)
+
+    try:
+        ordered_pipeline(chunks, fetch_and_score, write, concurrency)
+    finally:
+        if index is not None:
+            index.close()
+    flight.log_ratio(persons, "persons")
 
 def compare_dates(date1, date2):
     try:
@@ -133,33 +146,92 @@ def compare_dates(date1, date2):
     except ValueError:
         return False
 
-def match_persons():
+# ------------------ Blocking Persons ------------------
+
+NAME_PARTICLES = {"of", "the", "de", "da", "di", "del", "von", "van", "der", "al", "el", "and", "st", "saint"}
+
+def name_tokens(label):
+    """Lowercased word tokens of a name, without punctuation and common name particles."""
+    return {token for token in re.findall(r"\w+", label.lower()) if token not in NAME_PARTICLES}
+
+def date_year(date):
+    """Year of a date literal, read the same way compare_dates does; None if it has none."""
+    try:
+        return int(date.split("-")[0])
+    except ValueError:
+        return None
+
+def person_block_keys(label, birth, death, wikidata, date_blocking=True):
     """
-    Match persons after enrichment.
-    Two persons are considered the same if:
-      - They share the same Wikidata URI, OR
-      - Their effective labels (local label plus Wikidata info) are similar enough, OR
-      - Their birth and death dates are very close.
+    Blocking keys of a person: its name tokens, its Wikidata URI and,
+    with date_blocking, the decades of its birth and death dates.
     """
-    persons = query_persons_with_wikidata()
-    n = len(persons)
-    for i in range(n):
+    keys = {("token", token) for token in name_tokens(label)}
+    if wikidata:
+        keys.add(("wikidata", wikidata))
+    if date_blocking:
+        for kind, date in (("birth", birth), ("death", death)):
+            year = date_year(date) if date else None
+            if year is not None:
+                keys.add((kind, year // 10))
+    if not keys:
+        keys.add(("unkeyed",))
+    return keys
+
+def person_neighbour_keys(key):
+    """Decade keys neighbour the adjacent decades so that DATE_THRESHOLD years apart still meet."""
+    if key[0] in ("birth", "death"):
+        return [(key[0], key[1] + d) for d in (-1, 0, 1)]
+    return [key]
+
+def person_candidate_blocks(persons, exhaustive=False, date_blocking=True, changed=None):
+    """
+    Candidate blocks for the person rules, as (i, partners) with partners j > i: persons sharing
+    a name token, a Wikidata URI or (with date_blocking) a birth/death decade.
+    With exhaustive=True every pair is returned.
+    With a set of changed indices, only pairs involving a changed person are returned.
+    """
+    if exhaustive:
+        blocks = all_partners(len(persons))
+    else:
+        block_keys = [person_block_keys(label, birth, death, wikidata, date_blocking)
+                      for (_, label, birth, death, wikidata) in persons]
+        blocks = candidate_partners(block_keys, person_neighbour_keys)
+    if changed is not None:
+        blocks = incremental_partners(blocks, changed)
+    return blocks
+
+# ------------------ Matching Persons ------------------
+
+def score_person_blocks(persons, blocks, clusters=None):
+    """
+    Apply the person rules to (i, partners) candidate blocks.
+    Returns (decisions, compared) where decisions are (p1, p2, link type, rule, message) tuples in block order;
+    messages are only built when debug logging is on.
+    """
+    decisions, decide = collect_decisions(clusters, logger)
+    compared = 0
+
+    for i, partners in blocks:
         p1, label1, birth1, death1, wikidata1 = persons[i]
         effective_label1 = label1
         if wikidata1:
             effective_label1 = f"{label1} ({wikidata1})"
-        for j in range(i + 1, n):
+        for j in partners:
             p2, label2, birth2, death2, wikidata2 = persons[j]
+            if clusters is not None and clusters.connected(p1, p2):
+                continue
             effective_label2 = label2
             if wikidata2:
                 effective_label2 = f"{label2} ({wikidata2})"
-            
+            compared += 1
+
             # If both have a Wikidata URI and they are identical, we consider them the same.
             if wikidata1 and wikidata2 and (wikidata1 == wikidata2):
-                print(f"Inserting owl:sameAs for persons (same Wikidata resource):")
-                print(f"  {p1} ({effective_label1})")
-                print(f"  {p2} ({effective_label2})")
-                insert_same_as(p1, p2, "persons")
+                decide(p1, p2, SAME_AS, "same_wikidata",
+                       lambda: f"Inserting owl:sameAs for persons (same Wikidata resource):\n"
+                               f"  {p1} ({effective_label1})\n"
+                               f"  {p2} ({effective_label2})")
                 continue
 
             label_similarity = fuzz.ratio(effective_label1, effective_label2)
@@ -172,23 +244,51 @@ def match_persons():
 
             if label_similarity >= 95 or birth_match or death_match:
                 if birth_match or death_match:
-                    print(f"Inserting owl:sameAs for persons (date match):")
-                    print(f"  {p1} ({effective_label1}, born: {birth1}, died: {death1})")
-                    print(f"  {p2} ({effective_label2}, born: {birth2}, died: {death2})")
+                    rule = "date_match"
+                    message = lambda: (f"Inserting owl:sameAs for persons (date match):\n"
+                                       f"  {p1} ({effective_label1}, born: {birth1}, died: {death1})\n"
+                                       f"  {p2} ({effective_label2}, born: {birth2}, died: {death2})")
                 else:
-                    print(f"Inserting owl:sameAs for persons (label match):")
-                    print(f"  {p1} ({effective_label1})")
-                    print(f"  {p2} ({effective_label2})")
-                    print(f"  Label similarity: {label_similarity}%")
-                insert_same_as(p1, p2, "persons")
+                    rule = "label_match"
+                    message = lambda: (f"Inserting owl:sameAs for persons (label match):\n"
+                                       f"  {p1} ({effective_label1})\n"
+                                       f"  {p2} ({effective_label2})\n"
+                                       f"  Label similarity: {label_similarity}%")
+                decide(p1, p2, SAME_AS, rule, message)
             elif name_containment and not significant_name_difference:
-                print(f"Inserting closeMatch for persons (contained name):")
-                print(f"  {p1} ({effective_label1})")
-                print(f"  {p2} ({effective_label2})")
-                insert_close_match(p1, p2, "persons")
+                decide(p1, p2, CLOSE_MATCH, "contained_name",
+                       lambda: f"Inserting closeMatch for persons (contained name):\n"
+                               f"  {p1} ({effective_label1})\n"
+                               f"  {p2} ({effective_label2})")
             elif label_similarity >= 85:
-                print(f"Inserting closeMatch for persons (name only):")
-                print(f"  {p1} ({effective_label1})")
-                print(f"  {p2} ({effective_label2})")
-                print(f"  Label similarity: {label_similarity}%")
-                insert_close_match(p1, p2, "persons")
\ No newline at end of file
+                decide(p1, p2, CLOSE_MATCH, "name_only",
+                       lambda: f"Inserting closeMatch for persons (name only):\n"
+                               f"  {p1} ({effective_label1})\n"
+                               f"  {p2} ({effective_label2})\n"
+                               f"  Label similarity: {label_similarity}%")
+    return decisions, compared
+
+def match_persons(exhaustive=True, date_blocking=True, incremental=False, workers=MATCH_WORKERS, link_mode="clique"):
+    """
+    Match persons after enrichment.
+    Two persons are considered the same if:
+      - They share the same Wikidata URI, OR
+      - Their effective labels (local label plus Wikidata info) are similar enough, OR
+      - Their birth and death dates are very close.
+    Every pair is compared unless exhaustive is False, which compares the name-token blocks only.
+    Returns the number of pairs compared.
+    """
+    persons = list(query_persons_with_wikidata())
+    n = len(persons)
+    total_pairs = n * (n - 1) // 2
+    snapshot = MatchSnapshot("persons")
+    changed = None
+    if incremental:
+        changed = snapshot.changed(persons)
+        logger.info(f"Incremental run: {len(changed)} of {n} person rows are new or changed.")
+    blocks = person_candidate_blocks(persons, exhaustive, date_blocking, changed)
+    compared = write_matches("persons", score_person_blocks, persons, blocks, workers, link_mode, snapshot, persons)
+    snapshot.close()
+    ratio = compared / total_pairs * 100 if total_pairs else 0
+    logger.info(f"Compared {compared} of {total_pairs} person pairs ({ratio:.1f}%, {100 - ratio:.1f}% pruned by blocking).")
+    return compared
@@ -0,0 +1,58 @@
+# ------------------ SPARQL Protocol Client ------------------
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+RETRY_STATUS = (429, 500, 502, 503, 504)  # busy or temporarily failing endpoint
+
+class SparqlError(Exception):
+    """A SPARQL request the endpoint answered with an error status."""
+
+class SparqlEndpoint:
+    """
+    SPARQL 1.1 protocol client for one endpoint: select(query) returns the SPARQL JSON results and
+    update(query) runs an update, both as URL-encoded POSTs. Connections are kept alive in a pool of
+    pool_size per host, so threads share them without reconnecting for every request. Connection
+    errors and RETRY_STATUS answers are retried up to `retries` times with exponential backoff
+    (backoff, 2 * backoff, ... seconds). Updates are retried too; the pipeline's INSERT DATA and
+    date-rewrite updates give the same graph when applied twice.
+    """
+
+    def __init__(self, endpoint, user=None, password=None, pool_size=8, retries=3, backoff=0.5, timeout=300):
+        self.endpoint = endpoint
+        self.timeout = timeout
+        retry = Retry(total=retries, backoff_factor=backoff, status_forcelist=RETRY_STATUS,
+                      allowed_methods=None, raise_on_status=False)
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size, max_retries=retry)
+        self.session = requests.Session()
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        if user:
+            self.session.auth = (user, password)
+
+    def post(self, params, accept):
+        response = self.session.post(self.endpoint, data=params, headers={"Accept": accept}, timeout=self.timeout)
+        if response.status_code >= 400:
+            raise SparqlError(f"{response.status_code} from {self.endpoint}: {response.text[:500]}")
+        return response
+
+    def select(self, query):
+        return self.post({"query": query}, "application/sparql-results+json").json()
+
+    def update(self, query):
+        self.post({"update": query}, "*/*")
+
+    def close(self):
+        self.session.close()
+
+def insert_data_query(graph, triples):
+    """One INSERT DATA update adding N-Triples lines to the named graph."""
+    body = "\n".join(f"            {triple}" for triple in triples)
+    return f"""
+    INSERT DATA {{
+        GRAPH <{graph}> {{
+{body}
+        }}
+    }}
+    """
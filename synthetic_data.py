@@ -0,0 +1,163 @@
+# ------------------ Synthetic Benchmark Data ------------------
+
+import argparse
+import random
+from rdflib import Dataset, Literal, Namespace, URIRef
+from rdflib.namespace import OWL, RDF, RDFS
+
+CRM = Namespace("http://www.cidoc-crm.org/cidoc-crm/")
+EQ = Namespace("https://crm-eq.ics.forth.gr/ontology#")
+GEO = Namespace("http://www.w3.org/2003/01/geo/wgs84_pos#")
+DATA = Namespace("https://crm-eq.ics.forth.gr/data/")
+DATE_GRAPH = URIRef("http://localhost:8890/dataspace")  # graph rewritten by normalize_dates
+
+SYLLABLES = ["ka", "la", "mi", "no", "pe", "ri", "so", "ta", "vi", "ze", "tho", "phi", "chri", "dro", "ste", "and"]
+GIVEN_NAMES = ["Ioannes", "Georgios", "Maria", "Nikolaos", "Anna", "Theodoros", "Eleni", "Michael",
+               "Sophia", "Konstantinos", "Demetrios", "Irene", "Basil", "Helena", "Leo", "Zoe"]
+BBOX = (34.5, 41.5, 19.5, 28.5)  # lat/lon box (Greece and surroundings) for synthetic coordinates
+
+def synthetic_name(rng, syllables=3):
+    return "".join(rng.choice(SYLLABLES) for _ in range(syllables)).capitalize()
+
+def misspell(rng, text):
+    """Drop, double or swap one letter of text, the way transcriptions differ."""
+    if len(text) < 4:
+        return text
+    k = rng.randrange(1, len(text) - 1)
+    edit = rng.randrange(3)
+    if edit == 0:
+        return text[:k] + text[k + 1:]
+    if edit == 1:
+        return text[:k] + text[k] + text[k:]
+    return text[:k - 1] + text[k] + text[k - 1] + text[k + 1:]
+
+def with_duplicates(rng, n, dup_rate, make, vary):
+    """
+    n records: a (1 - dup_rate) share of originals from make(k), and duplicates made by
+    vary(original) of randomly chosen originals. Returns (records, duplicate_count).
+    """
+    originals = []
+    records = []
+    duplicates = 0
+    for k in range(n):
+        if originals and rng.random() < dup_rate:
+            records.append(vary(rng.choice(originals)))
+            duplicates += 1
+        else:
+            record = make(k)
+            originals.append(record)
+            records.append(record)
+    return records, duplicates
+
+def synthetic_places(rng, n, dup_rate):
+    """(label, lat, lon) tuples; duplicates are misspelled and moved by at most ~500 m."""
+    def make(k):
+        return (synthetic_name(rng), rng.uniform(BBOX[0], BBOX[1]), rng.uniform(BBOX[2], BBOX[3]))
+
+    def vary(place):
+        label, lat, lon = place
+        return (misspell(rng, label), lat + rng.uniform(-0.003, 0.003), lon + rng.uniform(-0.003, 0.003))
+
+    return with_duplicates(rng, n, dup_rate, make, vary)
+
+def synthetic_persons(rng, n, dup_rate):
+    """(label, birth, death) tuples with year literals; duplicates are misspelled or a year off."""
+    def make(k):
+        birth = rng.randint(1000, 1900) if rng.random() < 0.7 else None
+        death = birth + rng.randint(25, 85) if birth and rng.random() < 0.7 else None
+        return (f"{rng.choice(GIVEN_NAMES)} {synthetic_name(rng)}", birth, death)
+
+    def vary(person):
+        label, birth, death = person
+        if rng.random() < 0.5:
+            label = misspell(rng, label)
+        if birth and rng.random() < 0.5:
+            birth += rng.choice((-1, 1))
+        return (label, birth, death)
+
+    return with_duplicates(rng, n, dup_rate, make, vary)
+
+def synthetic_earthquakes(rng, n, dup_rate):
+    """
+    (label, begin, end, lat, lon) tuples with YYYY-MM-DD_HH:MM dates (some ends are a plain year,
+    for normalize_dates to rewrite); duplicates shift by up to an hour and ~10 km.
+    """
+    def make(k):
+        year = rng.randint(1000, 1900)
+        month, day, hour = rng.randint(1, 12), rng.randint(1, 28), rng.randint(0, 22)
+        begin = f"{year:04d}-{month:02d}-{day:02d}_{hour:02d}:00"
+        end = f"{year:04d}-{month:02d}-{day:02d}_{hour + 1:02d}:00" if rng.random() < 0.7 else str(year)
+        lat, lon = rng.uniform(BBOX[0], BBOX[1]), rng.uniform(BBOX[2], BBOX[3])
+        return (f"Earthquake of {synthetic_name(rng)} {year}", begin, end, lat, lon)
+
+    def vary(quake):
+        label, begin, end, lat, lon = quake
+        minute = rng.randint(0, 59)
+        return (misspell(rng, label), f"{begin[:-2]}{minute:02d}", end,
+                lat + rng.uniform(-0.05, 0.05), lon + rng.uniform(-0.05, 0.05))
+
+    return with_duplicates(rng, n, dup_rate, make, vary)
+
+def generate_dataset(places=1000, persons=1000, earthquakes=1000, dup_rate=0.1, seed=0):
+    """
+    Build an rdflib Dataset shaped like the data the matchers query: E53_Place with labels and
+    geo:lat/long, E21_Person with birth/death years, and EQ1_Earthquake with time-spans (in the
+    graph normalize_dates rewrites) and a located place. Returns (dataset, stats).
+    """
+    rng = random.Random(seed)
+    dataset = Dataset(default_union=True)
+    graph = dataset.graph(DATE_GRAPH)
+    stats = {}
+
+    rows, stats["place_duplicates"] = synthetic_places(rng, places, dup_rate)
+    for k, (label, lat, lon) in enumerate(rows):
+        place = DATA[f"place/{k}"]
+        graph.add((place, RDF.type, CRM.E53_Place))
+        graph.add((place, RDFS.label, Literal(label)))
+        graph.add((place, GEO.lat, Literal(f"{lat:.5f}")))
+        graph.add((place, GEO.long, Literal(f"{lon:.5f}")))
+
+    rows, stats["person_duplicates"] = synthetic_persons(rng, persons, dup_rate)
+    for k, (label, birth, death) in enumerate(rows):
+        person = DATA[f"person/{k}"]
+        graph.add((person, RDF.type, CRM.E21_Person))
+        graph.add((person, RDFS.label, Literal(label)))
+        if birth:
+            graph.add((person, EQ.P98i_was_born, Literal(str(birth))))
+        if death:
+            graph.add((person, EQ.P100i_died_in, Literal(str(death))))
+
+    rows, stats["earthquake_duplicates"] = synthetic_earthquakes(rng, earthquakes, dup_rate)
+    for k, (label, begin, end, lat, lon) in enumerate(rows):
+        quake = DATA[f"earthquake/{k}"]
+        span = DATA[f"earthquake/{k}/timespan"]
+        location = DATA[f"earthquake/{k}/place"]
+        located = URIRef(f"http://sws.geonames.org/synthetic/{k}/")
+        graph.add((quake, RDF.type, EQ.EQ1_Earthquake))
+        graph.add((quake, RDFS.label, Literal(label)))
+        graph.add((quake, EQ["PEQ5_has_documented_possible_timespan"], span))
+        graph.add((span, RDF.type, CRM["E52_Time-Span"]))
+        graph.add((span, CRM.P82a_begin_of_the_begin, Literal(begin)))
+        graph.add((span, CRM.P82b_end_of_the_end, Literal(end)))
+        graph.add((quake, CRM.P7_took_place_at, location))
+        graph.add((location, OWL.sameAs, located))
+        graph.add((located, GEO.lat, Literal(f"{lat:.5f}")))
+        graph.add((located, GEO.long, Literal(f"{lon:.5f}")))
+
+    stats.update(places=places, persons=persons, earthquakes=earthquakes, triples=len(dataset))
+    return dataset, stats
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Generate synthetic places, persons and earthquakes as RDF.")
+    parser.add_argument("output", help="Output file, e.g. synthetic.trig.")
+    parser.add_argument("--places", type=int, default=1000)
+    parser.add_argument("--persons", type=int, default=1000)
+    parser.add_argument("--earthquakes", type=int, default=1000)
+    parser.add_argument("--dup-rate", type=float, default=0.1, help="Share of records that duplicate an earlier one.")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    dataset, stats = generate_dataset(args.places, args.persons, args.earthquakes, args.dup_rate, args.seed)
+    dataset.serialize(args.output, format="trig")
+    print(f"Wrote {stats['triples']} triples to {args.output}.")
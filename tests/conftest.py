@@ -0,0 +1,23 @@
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+import config
+from graph_store import LocalGraphStore
+from synthetic_data import generate_dataset
+
+
+@pytest.fixture
+def dataset(tmp_path, monkeypatch):
+    """Synthetic data on a local graph, with snapshots written to a temporary directory."""
+    monkeypatch.chdir(tmp_path)
+    dataset, _ = generate_dataset(places=10, persons=40, earthquakes=10, dup_rate=0.2, seed=1)
+    reader, writer, local_store = config.sparql.reader, config.sparql.writer, config.local_store
+    config.use_local_graph(LocalGraphStore(dataset))
+    yield dataset
+    config.use_export(None)
+    config.local_store = local_store
+    config.sparql.reader, config.sparql.writer = reader, writer
@@ -0,0 +1,15 @@
+from datetime import datetime
+
+from date_parsing import parse_date, normalize_date_string
+
+
+def test_bare_number_is_not_a_date():
+    assert parse_date("10") is None
+    assert parse_date("March 10") is None
+    assert normalize_date_string("10") is None
+
+
+def test_dateutil_dates_with_a_year_still_parse():
+    assert parse_date("8 March 1750").start == datetime(1750, 3, 8)
+    assert parse_date("12 May 850").start == datetime(850, 5, 12)
+    assert parse_date("circa 1750").start.year == 1750
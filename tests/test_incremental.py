@@ -0,0 +1,40 @@
+import sqlite3
+
+import config
+import match_eq
+import person_match
+from link_export import TripleExport
+from utils import MATCH_SNAPSHOT_DB, custom_graph
+
+
+def person_links(dataset):
+    return len(dataset.graph(custom_graph("persons")))
+
+
+def test_incremental_run_after_dry_run_writes_all_links(dataset):
+    config.use_export(TripleExport(None))
+    person_match.match_persons(incremental=True)
+    assert person_links(dataset) == 0
+
+    config.use_export(None)
+    compared = person_match.match_persons(incremental=True)
+    assert compared > 0
+    assert person_links(dataset) > 0
+
+
+def snapshot_dump():
+    connection = sqlite3.connect(MATCH_SNAPSHOT_DB)
+    try:
+        return list(connection.iterdump())
+    finally:
+        connection.close()
+
+
+def test_dry_run_leaves_snapshot_unchanged(dataset):
+    person_match.match_persons(incremental=True)
+    before = snapshot_dump()
+
+    config.use_export(TripleExport(None))
+    person_match.match_persons(incremental=True)
+    match_eq.match_earthquakes()
+    assert snapshot_dump() == before
@@ -0,0 +1,33 @@
+from rdflib import Literal
+from rdflib.namespace import RDF, RDFS
+
+import person_match
+from synthetic_data import CRM, DATA, DATE_GRAPH
+from utils import custom_graph
+
+MISSPELLED = ["Leo Zeppetho", "Le Zepetho", "Leo ZZepetho"]
+
+
+def add_persons(dataset, labels):
+    graph = dataset.graph(DATE_GRAPH)
+    for k, label in enumerate(labels):
+        person = DATA[f"person/misspelled/{k}"]
+        graph.add((person, RDF.type, CRM.E21_Person))
+        graph.add((person, RDFS.label, Literal(label)))
+
+
+def person_links(dataset, **options):
+    graph = dataset.graph(custom_graph("persons"))
+    graph.remove((None, None, None))
+    person_match.match_persons(**options)
+    return set(graph)
+
+
+def test_default_run_keeps_the_links_of_misspelled_names(dataset):
+    add_persons(dataset, MISSPELLED)
+    exhaustive = person_links(dataset, exhaustive=True)
+    assert person_links(dataset) == exhaustive
+
+    misspelled = {DATA[f"person/misspelled/{k}"] for k in range(len(MISSPELLED))}
+    assert any(s in misspelled and o in misspelled for s, _, o in exhaustive)
+    assert person_links(dataset, exhaustive=False) < exhaustive
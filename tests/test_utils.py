@@ -0,0 +1,31 @@
+import threading
+import time
+
+import pytest
+
+from utils import ordered_pipeline
+
+
+def test_ordered_pipeline_consumes_in_input_order():
+    consumed = []
+    ordered_pipeline(range(20), lambda item: item * item, lambda item, result: consumed.append((item, result)),
+                     concurrency=4)
+    assert consumed == [(item, item * item) for item in range(20)]
+
+
+def test_ordered_pipeline_stops_fetching_once_consume_fails():
+    fetched = []
+    lock = threading.Lock()
+
+    def work(item):
+        with lock:
+            fetched.append(item)
+        time.sleep(0.01)
+        return item
+
+    def consume(item, result):
+        raise RuntimeError("write failed")
+
+    with pytest.raises(RuntimeError, match="write failed"):
+        ordered_pipeline(range(100), work, consume, concurrency=4)
+    assert len(fetched) <= 3 * 4
@@ -1,51 +1,712 @@
 # ------------------ Utility Functions ------------------
 
+import bisect
+import hashlib
+import json
+import logging
 import math
+import multiprocessing
+import queue
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, Future, FIRST_COMPLETED, wait
+import numpy as np
 from rdflib import Graph, URIRef, Namespace
 from SPARQLWrapper import SPARQLWrapper, JSON, POST
-from config import sparql, GEONAMES_USERNAME, EARTHQUAKE_MODEL
+from config import sparql, GEONAMES_USERNAME, EARTHQUAKE_MODEL, LINK_BATCH_SIZE, PAGE_SIZE, PAIRS_PER_TASK
+from cache_store import SQLiteCache
+from sparql_client import insert_data_query
+from metrics import metrics
 
+logger = logging.getLogger(__name__)
+
+
+EARTH_RADIUS_KM = 6371
+KM_PER_DEGREE = 111.32  # length of a degree of latitude (and of longitude at the equator)
 
 def haversine(lat1, lon1, lat2, lon2):
     """Calculate the great-circle distance (in km) between two points."""
-    R = 6371  # Earth's radius in km
+    R = EARTH_RADIUS_KM
     dLat = math.radians(lat2 - lat1)
     dLon = math.radians(lon2 - lon1)
     a = math.sin(dLat/2)**2 + math.cos(math.radians(lat1)) * math.cos(math.radians(lat2)) * math.sin(dLon/2)**2
     c = 2 * math.atan2(math.sqrt(a), math.sqrt(1 - a))
     return R * c
 
+def parse_coordinates(values):
+    """Convert coordinate literals to a float array; missing or malformed values become NaN."""
+    coords = np.full(len(values), np.nan)
+    for i, value in enumerate(values):
+        if value:
+            try:
+                coords[i] = float(value)
+            except ValueError:
+                pass
+    return coords
+
+def haversine_one_to_many(lat, lon, lats, lons):
+    """
+    Great-circle distances (in km) from one point to many points.
+    All coordinates are in radians; lats/lons are NumPy arrays.
+    """
+    a = np.sin((lats - lat) / 2) ** 2 + np.cos(lat) * np.cos(lats) * np.sin((lons - lon) / 2) ** 2
+    return 2 * EARTH_RADIUS_KM * np.arcsin(np.sqrt(np.clip(a, 0.0, 1.0)))
+
+def haversine_many_to_many(lats1, lons1, lats2, lons2):
+    """
+    Great-circle distance matrix (in km) between two sets of points given in radians.
+    Entry [i, j] is the distance between point i of the first set and point j of the second.
+    """
+    return haversine_one_to_many(lats1[:, None], lons1[:, None], lats2[None, :], lons2[None, :])
+
+class GridIndex:
+    """
+    Spatial index that buckets points into a lat/lon grid so that radius queries
+    only compute distances to points of the surrounding cells.
+    Points with NaN coordinates are not indexed.
+    """
+
+    def __init__(self, lats, lons, cell_km):
+        self.lats = np.radians(np.asarray(lats, dtype=float))
+        self.lons = np.radians(np.asarray(lons, dtype=float))
+        self.cell_deg = cell_km / KM_PER_DEGREE
+        self.cols = max(1, int(math.ceil(360 / self.cell_deg)))
+        buckets = {}
+        valid = ~(np.isnan(self.lats) | np.isnan(self.lons))
+        for i in np.flatnonzero(valid):
+            buckets.setdefault(self._cell(math.degrees(self.lats[i]), math.degrees(self.lons[i])), []).append(i)
+        self.buckets = {cell: np.array(members) for cell, members in buckets.items()}
+
+    def _cell(self, lat, lon):
+        return (math.floor(lat / self.cell_deg), math.floor((lon + 180) / self.cell_deg) % self.cols)
+
+    def _nearby_cells(self, lat, lon, radius_km):
+        row, col = self._cell(lat, lon)
+        row_reach = math.ceil(radius_km / KM_PER_DEGREE / self.cell_deg)
+        # A degree of longitude shrinks towards the poles, so widen the column reach there.
+        edge_lat = abs(lat) + radius_km / KM_PER_DEGREE
+        if edge_lat >= 89.0:
+            cols = range(self.cols)
+        else:
+            col_reach = math.ceil(radius_km / (KM_PER_DEGREE * math.cos(math.radians(edge_lat))) / self.cell_deg)
+            cols = range(col - col_reach, col + col_reach + 1) if 2 * col_reach + 1 < self.cols else range(self.cols)
+        return [(r, c % self.cols) for r in range(row - row_reach, row + row_reach + 1) for c in cols]
+
+    def query_radius(self, lat, lon, radius_km):
+        """Return (indices, distances) of the indexed points within radius_km of (lat, lon) in degrees."""
+        members = [self.buckets[cell] for cell in self._nearby_cells(lat, lon, radius_km) if cell in self.buckets]
+        if not members:
+            return np.array([], dtype=int), np.array([])
+        candidates = np.unique(np.concatenate(members))
+        distances = haversine_one_to_many(math.radians(lat), math.radians(lon),
+                                          self.lats[candidates], self.lons[candidates])
+        within = distances <= radius_km
+        return candidates[within], distances[within]
+
+    def pairs_within(self, radius_km):
+        """Return {(i, j): distance} for all indexed point pairs, i < j, at most radius_km apart."""
+        pairs = {}
+        for members in self.buckets.values():
+            for i in members:
+                indices, distances = self.query_radius(math.degrees(self.lats[i]), math.degrees(self.lons[i]), radius_km)
+                for j, distance in zip(indices, distances):
+                    if j > i:
+                        pairs[(int(i), int(j))] = float(distance)
+        return pairs
+
+class TokenBucket:
+    """
+    Thread-safe token-bucket rate limiter: tokens refill at `rate` per second
+    up to `capacity`, and each request consumes one.
+    """
+
+    def __init__(self, rate, capacity=1):
+        self.rate = rate
+        self.capacity = max(1, capacity)
+        self.tokens = float(self.capacity)
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def try_acquire(self):
+        """Take a token if one is available; otherwise return the seconds until the next one."""
+        with self.lock:
+            self._refill()
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return 0.0
+            return (1 - self.tokens) / self.rate
+
+    def acquire(self):
+        """Block until a token is available and take it."""
+        while True:
+            wait = self.try_acquire()
+            if not wait:
+                return
+            time.sleep(wait)
+
+def ordered_pipeline(items, work, consume, concurrency=4, queue_size=None):
+    """
+    Run work(item) on a pool of `concurrency` threads and hand the results to
+    consume(item, result) on a separate writer thread, connected by a bounded queue.
+    At most `concurrency` items are in flight, and results are consumed in input order
+    regardless of completion order. Once consume raises, no further items are submitted,
+    pending ones are cancelled and the error is raised.
+    """
+    concurrency = max(1, concurrency)
+    results = queue.Queue(maxsize=queue_size or 2 * concurrency)
+    failure = []
+
+    def writer():
+        while True:
+            entry = results.get()
+            if entry is None:
+                return
+            if not failure:
+                try:
+                    consume(*entry)
+                except Exception as e:
+                    failure.append(e)
+
+    writer_thread = threading.Thread(target=writer, daemon=True)
+    writer_thread.start()
+    try:
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            in_flight = deque()
+            try:
+                for item in items:
+                    if failure:
+                        break
+                    in_flight.append((item, executor.submit(work, item)))
+                    if len(in_flight) >= concurrency:
+                        done_item, future = in_flight.popleft()
+                        results.put((done_item, future.result()))
+                while in_flight and not failure:
+                    done_item, future = in_flight.popleft()
+                    results.put((done_item, future.result()))
+            finally:
+                for _, future in in_flight:
+                    future.cancel()
+    finally:
+        results.put(None)
+        writer_thread.join()
+    if failure:
+        raise failure[0]
+
+class SingleFlight:
+    """
+    Coalesces lookups by key for one run. The first caller of a key resolves it; concurrent
+    callers of the same key wait for that result and later callers get it at once, so each
+    distinct key is looked up exactly once and its result fans out to every entity sharing it.
+    name labels the counters (lookups.<name>.keys / .calls) and the log_ratio summary.
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.lock = threading.Lock()
+        self.futures = {}
+        self.calls = 0
+
+    def claim(self, key):
+        """Return (future, leader); a leader must resolve the future with set_result or set_exception."""
+        with self.lock:
+            self.calls += 1
+            future = self.futures.get(key)
+            if future is not None:
+                return future, False
+            future = self.futures[key] = Future()
+            return future, True
+
+    def do(self, key, fn):
+        """Return fn() for the first caller of key and the same result for every other one."""
+        future, leader = self.claim(key)
+        if leader:
+            try:
+                future.set_result(fn())
+            except Exception as e:
+                future.set_exception(e)
+        return future.result()
+
+    def log_ratio(self, entities, noun):
+        """Count and log the distinct keys resolved against the number of entities enriched."""
+        keys = len(self.futures)
+        metrics.count(f"lookups.{self.name}.keys", keys)
+        metrics.count(f"lookups.{self.name}.calls", self.calls)
+        if entities:
+            logger.info(f"Resolved {keys} distinct {self.name} lookups for {entities} {noun} "
+                        f"({keys / entities:.2f} keys per entity, {self.calls - keys} lookups coalesced).")
+
+def run_stages(stages, max_concurrent=None):
+    """
+    Run a DAG of pipeline stages on a thread pool. stages maps a name to (callable, dependencies);
+    a stage starts as soon as every dependency that is also in stages has finished, so independent
+    stages overlap and the run takes about as long as its longest dependency path.
+    At most max_concurrent stages run at once (None: no limit; 1: one after the other in
+    declaration order). Each stage is timed with metrics.stage. When a stage fails, no further
+    stages are started and the first error is raised once the running ones have finished.
+    """
+    pending = {name: {dep for dep in deps if dep in stages} for name, (_, deps) in stages.items()}
+    for name, deps in pending.items():
+        if name in deps:
+            raise ValueError(f"Stage {name} depends on itself")
+    done = set()
+    failure = []
+
+    def run(name):
+        threading.current_thread().name = name
+        with metrics.stage(name):
+            stages[name][0]()
+
+    with ThreadPoolExecutor(max_workers=max_concurrent or len(stages) or 1) as executor:
+        running = {}
+        while pending or running:
+            if not failure:
+                for name in [name for name, deps in pending.items() if deps <= done]:
+                    if max_concurrent and len(running) >= max_concurrent:
+                        break
+                    del pending[name]
+                    logger.info(f"Starting stage {name}.")
+                    running[executor.submit(run, name)] = name
+            if not running:
+                if pending and not failure:
+                    raise ValueError(f"Stage dependencies form a cycle: {', '.join(sorted(pending))}")
+                break
+            finished, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in finished:
+                name = running.pop(future)
+                try:
+                    future.result()
+                    done.add(name)
+                except Exception as e:
+                    logger.error(f"Stage {name} failed: {e}")
+                    failure.append(e)
+    if failure:
+        raise failure[0]
+
+def all_partners(n):
+    """Yield (i, partners) with every j > i as partners, as the exhaustive matching loops do."""
+    for i in range(n):
+        yield i, range(i + 1, n)
+
+def all_pairs(n):
+    """Yield every index pair (i, j) with i < j, as the exhaustive matching loops do."""
+    for i, partners in all_partners(n):
+        for j in partners:
+            yield i, j
+
+def candidate_partners(block_keys, neighbours=None, extra_pairs=()):
+    """
+    Yield (i, partners) where partners is the sorted list of indices j > i of entities that
+    share a block with entity i or sit in a neighbouring block.
+    block_keys[i] holds the block keys of entity i; neighbours(key) returns the keys adjacent
+    to key (key itself included). Pairs in extra_pairs (e.g. from a GridIndex) are added as well.
+    """
+    extra = {}
+    for i, j in extra_pairs:
+        extra.setdefault(i, set()).add(j)
+    index = {}
+    for i, keys in enumerate(block_keys):
+        for key in keys:
+            index.setdefault(key, []).append(i)
+    for i, keys in enumerate(block_keys):
+        partners = set()
+        for key in keys:
+            for near in (neighbours(key) if neighbours else (key,)):
+                partners.update(j for j in index.get(near, ()) if j > i)
+        partners.update(extra.get(i, ()))
+        if partners:
+            yield i, sorted(partners)
+
+def candidate_pairs(block_keys, neighbours=None, extra_pairs=()):
+    """
+    Yield index pairs (i, j), i < j, of entities that share a block or sit in neighbouring blocks
+    (see candidate_partners). Pairs come out in the same order as the exhaustive loop.
+    """
+    for i, partners in candidate_partners(block_keys, neighbours, extra_pairs):
+        for j in partners:
+            yield i, j
+
+def incremental_partners(blocks, changed):
+    """
+    Restrict (i, partners) blocks to the pairs that involve at least one changed entity:
+    a changed i keeps all its partners, an unchanged i keeps only its changed partners.
+    changed is a set of indices; pairs of two unchanged entities were matched by an earlier run.
+    """
+    changed_sorted = sorted(changed)
+    for i, partners in blocks:
+        if i in changed:
+            yield i, partners
+            continue
+        if isinstance(partners, range):
+            kept = changed_sorted[bisect.bisect_left(changed_sorted, partners.start):
+                                  bisect.bisect_left(changed_sorted, partners.stop)]
+        else:
+            kept = [j for j in partners if j in changed]
+        if kept:
+            yield i, kept
+
+# ------------------ Parallel Pair Scoring ------------------
+
+def chunked_blocks(blocks, pairs_per_chunk=PAIRS_PER_TASK):
+    """Group (i, partners) blocks into lists holding about pairs_per_chunk pairs each."""
+    chunk = []
+    pairs = 0
+    for i, partners in blocks:
+        chunk.append((i, partners))
+        pairs += len(partners)
+        if pairs >= pairs_per_chunk:
+            yield chunk
+            chunk = []
+            pairs = 0
+    if chunk:
+        yield chunk
+
+_scoring_state = None
+
+def _init_scoring_worker(score, data, clustered, log_level):
+    global _scoring_state
+    _scoring_state = (score, data, clustered)
+    logging.getLogger().setLevel(log_level)
+
+def scoring_context():
+    """
+    Start method of the scoring pool: forkserver where available, since forking a process whose
+    pipeline stages run on several threads can copy locks held by the other threads.
+    """
+    if "forkserver" in multiprocessing.get_all_start_methods():
+        return multiprocessing.get_context("forkserver")
+    return None
+
+def _score_chunk(chunk):
+    score, data, clustered = _scoring_state
+    return score(data, chunk, DisjointSet() if clustered else None)
+
+def score_blocks(score, data, blocks, workers=1, clusters=None, pairs_per_chunk=PAIRS_PER_TASK):
+    """
+    Run score(data, chunk, clusters) over chunks of (i, partners) blocks and yield the
+    (decisions, compared) result of every chunk in block order. Decisions are
+    (entity1, entity2, link type, rule, message) tuples. With workers > 1 the chunks are
+    scored on a process pool: data is sent to each worker once, at most 2 * workers chunks are in
+    flight, and score must be a module-level function. Workers log at the parent's root log level.
+    With a DisjointSet of sameAs clusters, the scorer skips pairs already in one cluster. Pool
+    workers only know the clusters of their own chunk, so their decisions are filtered again
+    against clusters here, which gives the same decisions as the serial run.
+    """
+    chunks = chunked_blocks(blocks, pairs_per_chunk)
+    if workers <= 1:
+        for chunk in chunks:
+            yield score(data, chunk, clusters)
+        return
+    with ProcessPoolExecutor(max_workers=workers, mp_context=scoring_context(), initializer=_init_scoring_worker,
+                             initargs=(score, data, clusters is not None, logging.getLogger().level)) as executor:
+        in_flight = deque()
+
+        def result(future):
+            decisions, compared = future.result()
+            if clusters is not None:
+                decisions = [decision for decision in decisions if clusters.accept(*decision[:3])]
+            return decisions, compared
+
+        for chunk in chunks:
+            in_flight.append(executor.submit(_score_chunk, chunk))
+            if len(in_flight) >= 2 * workers:
+                yield result(in_flight.popleft())
+        while in_flight:
+            yield result(in_flight.popleft())
+
+def collect_decisions(clusters, log):
+    """
+    The decisions list of a scorer and the decide(entity1, entity2, link type, rule, message) call
+    that fills it. Pairs the sameAs clusters reject are dropped, and message() is only built
+    when log is at DEBUG level.
+    """
+    decisions = []
+    verbose = log.isEnabledFor(logging.DEBUG)
+
+    def decide(entity1, entity2, link_type, rule, message):
+        if clusters is None or clusters.accept(entity1, entity2, link_type):
+            decisions.append((entity1, entity2, link_type, rule, message() if verbose else None))
+
+    return decisions, decide
+
+# ------------------ sameAs Clusters ------------------
+
+LINK_MODES = ("clique", "spanning", "canonical")
+
+class DisjointSet:
+    """
+    Union-find over entity ids, with path halving and union by size.
+    Each set is a cluster of entities joined by owl:sameAs decisions.
+    """
+
+    def __init__(self):
+        self.parent = {}
+        self.size = {}
+
+    def find(self, x):
+        parent = self.parent
+        if x not in parent:
+            return x
+        while parent[x] != x:
+            parent[x] = parent[parent[x]]
+            x = parent[x]
+        return x
+
+    def union(self, a, b):
+        """Join the clusters of a and b; returns False if they were already one cluster."""
+        for x in (a, b):
+            if x not in self.parent:
+                self.parent[x] = x
+                self.size[x] = 1
+        root_a, root_b = self.find(a), self.find(b)
+        if root_a == root_b:
+            return False
+        if self.size[root_a] < self.size[root_b]:
+            root_a, root_b = root_b, root_a
+        self.parent[root_b] = root_a
+        self.size[root_a] += self.size.pop(root_b)
+        return True
+
+    def connected(self, a, b):
+        return a == b or self.find(a) == self.find(b)
+
+    def accept(self, a, b, link_type):
+        """
+        Record a link decision and return whether it adds anything: a sameAs that joins two
+        clusters, or a closeMatch between entities not already in one cluster.
+        """
+        if link_type == SAME_AS:
+            return self.union(a, b)
+        return not self.connected(a, b)
+
+    def clusters(self):
+        """Lists of the members of every cluster with more than one entity."""
+        members = {}
+        for x in self.parent:
+            members.setdefault(self.find(x), []).append(x)
+        return [sorted(cluster) for cluster in members.values()]
+
+def finish_clusters(clusters, links, typeEntity, canonical=False):
+    """
+    Report the sameAs cluster sizes and, when canonical, write one owl:sameAs link from every
+    member to its cluster's representative (the smallest id) instead of the links decided pairwise.
+    """
+    clusters_list = clusters.clusters()
+    sizes = {}
+    for cluster in clusters_list:
+        sizes[len(cluster)] = sizes.get(len(cluster), 0) + 1
+    clique_links = sum(len(cluster) * (len(cluster) - 1) // 2 for cluster in clusters_list)
+    member_links = sum(len(cluster) - 1 for cluster in clusters_list)
+    if canonical:
+        for cluster in clusters_list:
+            for member in cluster[1:]:
+                links.same_as(member, cluster[0], typeEntity)
+    histogram = ", ".join(f"{count} x {size}" for size, count in sorted(sizes.items()))
+    metrics.count(f"clusters.{typeEntity}", len(clusters_list))
+    logger.info(f"{len(clusters_list)} {typeEntity} sameAs clusters (size: {histogram or 'none'}); "
+                f"{member_links} sameAs links instead of {clique_links} for the full cliques.")
+
+# ------------------ Incremental Matching ------------------
+
+MATCH_SNAPSHOT_DB = "match_snapshot.sqlite"
+
+class MatchSnapshot:
+    """
+    Fingerprints of the entities (places, persons, earthquakes) seen by the last matching run,
+    persisted in a SQLite table per entity type. An entity's fingerprint covers all of its rows,
+    so an entity counts as changed when it is new or any of its matched attributes differ.
+    The SQLite file is only opened once the snapshot is read or saved.
+    """
+
+    def __init__(self, typeEntity, path=MATCH_SNAPSHOT_DB):
+        self.path = path
+        self.table = f"snapshot_{typeEntity}"
+        self._cache = None
+
+    @property
+    def cache(self):
+        if self._cache is None:
+            self._cache = SQLiteCache(self.path, table=self.table)
+        return self._cache
+
+    @staticmethod
+    def fingerprints(rows):
+        """{entity id: fingerprint} for rows whose first column is the entity id."""
+        grouped = {}
+        for row in rows:
+            grouped.setdefault(row[0], []).append(json.dumps(list(row[1:])))
+        return {entity: hashlib.sha1("\n".join(sorted(values)).encode("utf-8")).hexdigest()
+                for entity, values in grouped.items()}
+
+    def changed(self, rows):
+        """Indices of the rows whose entity is new or changed since the last saved snapshot."""
+        previous = dict(self.cache.items())
+        current = self.fingerprints(rows)
+        dirty = {entity for entity, fingerprint in current.items() if previous.get(entity) != fingerprint}
+        return {i for i, row in enumerate(rows) if row[0] in dirty}
+
+    def save(self, rows):
+        """Replace the snapshot with the entities of rows."""
+        self.cache.put_many(self.fingerprints(rows).items(), replace=True)
+
+    def close(self):
+        if self._cache is not None:
+            self._cache.close()
+
+def sparql_string(value):
+    """Quote a Python string as a SPARQL string literal."""
+    escaped = value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n").replace("\r", "\\r")
+    return f'"{escaped}"'
+
+def paged_select(query, order_by, page_size=PAGE_SIZE, on_page=None):
+    """
+    Run a SELECT query page by page (ORDER BY order_by, LIMIT page_size, OFFSET) and yield
+    its result bindings as they arrive, so large result sets never have to be fetched at once.
+    order_by should list enough variables to give the rows a stable order.
+    on_page(page_number, rows_in_page) is called after every page.
+    Pages are read through the shared client's read pool, so writes can go on while pages stream in.
+    """
+    page_size = max(1, page_size)
+    page = 0
+    while True:
+        query_page = f"{query}\nORDER BY {order_by}\nLIMIT {page_size}\nOFFSET {page * page_size}"
+        bindings = sparql.select(query_page)["results"]["bindings"]
+        page += 1
+        if on_page:
+            on_page(page, len(bindings))
+        yield from bindings
+        if len(bindings) < page_size:
+            return
+
+def chunked(iterable, size):
+    """Yield lists of up to size consecutive items of iterable."""
+    chunk = []
+    for item in iterable:
+        chunk.append(item)
+        if len(chunk) >= size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+CUSTOM = f"{EARTHQUAKE_MODEL}/custom/"  # namespace of the graphs and the closeMatch property the pipeline writes
+OWL_SAME_AS = "http://www.w3.org/2002/07/owl#sameAs"
+CUSTOM_CLOSE_MATCH = f"{CUSTOM}closeMatch"
+
+def custom_graph(typeEntity):
+    """IRI of the custom:{typeEntity} graph (places, persons, earthquakes, geonames, wikidata)."""
+    return f"{CUSTOM}{typeEntity}"
+
+def links_insert_query(typeEntity, triples):
+    """Build one INSERT DATA request adding the given link triples to the custom:{typeEntity} graph."""
+    return insert_data_query(custom_graph(typeEntity), triples)
+
+def same_as_triple(entity1, entity2):
+    return f"<{entity1}> <{OWL_SAME_AS}> <{entity2}> ."
+
+def close_match_triple(entity1, entity2):
+    return f"<{entity1}> <{CUSTOM_CLOSE_MATCH}> <{entity2}> ."
+
+def literal_triple(subject, predicate, value, datatype=None):
+    """N-Triples line with a string literal object (typed with the datatype IRI when given)."""
+    return f"<{subject}> <{predicate}> {sparql_string(str(value))}{f'^^<{datatype}>' if datatype else ''} ."
+
+SAME_AS = "sameAs"
+CLOSE_MATCH = "closeMatch"
+LINK_TRIPLES = {SAME_AS: same_as_triple, CLOSE_MATCH: close_match_triple}
+
 def insert_same_as(entity1, entity2, typeEntity):
     """Insert an owl:sameAs triple linking two entities."""
-    graph_name = f"https://crm-eq.ics.forth.gr/ontology#/custom/{typeEntity}"
-    
-    
-    update_query = f"""
-    PREFIX owl: <http://www.w3.org/2002/07/owl#>
-    PREFIX custom: <{EARTHQUAKE_MODEL}/custom/>
-    INSERT DATA {{
-        GRAPH custom:{typeEntity} {{
-            <{entity1}> owl:sameAs <{entity2}> .
-        }}
-    }}
-    """
-    sparql.setQuery(update_query)
-    sparql.setMethod(POST)
-    sparql.query()
+    sparql.insert(custom_graph(typeEntity), [same_as_triple(entity1, entity2)])
 
 def insert_close_match(entity1, entity2, typeEntity):
     """Insert a custom:closeMatch triple linking two similar entities."""
-    graph_name = f"https://crm-eq.ics.forth.gr/ontology#/custom/{typeEntity}"
-    
-    update_query = f"""
-    PREFIX custom: <{EARTHQUAKE_MODEL}/custom/>
-    INSERT DATA {{
-        GRAPH custom:{typeEntity} {{
-            <{entity1}> custom:closeMatch <{entity2}> .
-        }}
-    }}
-    """
-    sparql.setQuery(update_query)
-    sparql.setMethod("POST")
-    sparql.query()
+    sparql.insert(custom_graph(typeEntity), [close_match_triple(entity1, entity2)])
+
+class LinkWriter:
+    """
+    Buffer owl:sameAs / custom:closeMatch links per named graph (custom:persons,
+    custom:places, custom:earthquakes, ...) and write them as multi-triple INSERT DATA
+    requests of at most batch_size triples (or to the export files, see config.use_export).
+    Use it as a context manager so the remaining links are flushed on exit.
+    """
+
+    def __init__(self, batch_size=LINK_BATCH_SIZE):
+        self.batch_size = max(1, batch_size)
+        self.buffers = {}
+        self.triples_written = 0
+        self.requests_sent = 0
+
+    def same_as(self, entity1, entity2, typeEntity):
+        self.add(typeEntity, same_as_triple(entity1, entity2))
+
+    def close_match(self, entity1, entity2, typeEntity):
+        self.add(typeEntity, close_match_triple(entity1, entity2))
+
+    def link(self, entity1, entity2, link_type, typeEntity):
+        """Add a link of type SAME_AS or CLOSE_MATCH."""
+        self.add(typeEntity, LINK_TRIPLES[link_type](entity1, entity2))
 
+    def add(self, typeEntity, triple):
+        buffer = self.buffers.setdefault(typeEntity, [])
+        buffer.append(triple)
+        if len(buffer) >= self.batch_size:
+            self.flush(typeEntity)
+
+    def flush(self, typeEntity=None):
+        """Send the buffered links of one graph, or of all graphs when typeEntity is None."""
+        for graph in ([typeEntity] if typeEntity else list(self.buffers)):
+            triples = self.buffers.pop(graph, [])
+            if not triples:
+                continue
+            sparql.insert(custom_graph(graph), triples)
+            self.triples_written += len(triples)
+            self.requests_sent += 1
+            metrics.count(f"links.{graph}", len(triples))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.flush()
+        if sparql.exporter is None:
+            logger.info(f"Wrote {self.triples_written} link triples in {self.requests_sent} requests.")
+        elif sparql.exporter.directory:
+            logger.info(f"Exported {self.triples_written} link triples to {sparql.exporter.directory}.")
+        else:
+            logger.info(f"Would write {self.triples_written} link triples (dry run).")
+        return False
+
+# ------------------ Writing Matches ------------------
+
+def write_matches(typeEntity, score, data, blocks, workers=1, link_mode="clique", snapshot=None, rows=None):
+    """
+    Score the candidate blocks with score_blocks and write the links decided for typeEntity,
+    clustered according to link_mode (see LINK_MODES). Decision messages go to the scorer's logger.
+    The snapshot is saved with rows once the links are written to the endpoint; exported
+    links are not in the endpoint yet, so it is left alone under use_export.
+    Returns the number of pairs compared.
+    """
+    log = logging.getLogger(score.__module__)
+    clusters = DisjointSet() if link_mode != "clique" else None
+    compared = 0
+    with LinkWriter() as links:
+        for decisions, chunk_compared in score_blocks(score, data, blocks, workers, clusters):
+            compared += chunk_compared
+            for entity1, entity2, link_type, rule, message in decisions:
+                metrics.count(f"rules.{typeEntity}.{rule}")
+                if message:
+                    log.debug(message)
+                if link_mode != "canonical" or link_type != SAME_AS:
+                    links.link(entity1, entity2, link_type, typeEntity)
+        if clusters is not None:
+            finish_clusters(clusters, links, typeEntity, link_mode == "canonical")
+    if snapshot is not None and sparql.exporter is None:
+        snapshot.save(rows)
+    metrics.count(f"pairs_compared.{typeEntity}", compared)
+    return compared
@@ -0,0 +1,232 @@
+# ------------------ Offline Wikidata Index ------------------
+
+import argparse
+import bz2
+import gzip
+import itertools
+import json
+import os
+import re
+import sqlite3
+import threading
+from utils import chunked
+
+WIKIDATA_ENTITY = "http://www.wikidata.org/entity/"
+WIKIDATA_PROP = "http://www.wikidata.org/prop/direct/"
+XSD_DATE_TIME = "http://www.w3.org/2001/XMLSchema#dateTime"
+HUMAN = "Q5"
+PROPERTIES = ("P734", "P569", "P570", "P106")  # family name, birth date, death date, occupation
+ITEM_PROPERTIES = ("P734", "P106")            # properties whose values are items with labels of their own
+LABEL_PREDICATES = {
+    "http://www.w3.org/2000/01/rdf-schema#label",
+    "http://schema.org/name",
+    "http://www.w3.org/2004/02/skos/core#prefLabel",
+}
+INSERT_BATCH = 10000  # dump entities (or triples) per SQLite transaction while building
+
+NT_LINE = re.compile(r'^<([^>]*)>\s+<([^>]*)>\s+(.*?)\s*\.\s*$')
+NT_LITERAL = re.compile(r'^"((?:[^"\\]|\\.)*)"(?:@([A-Za-z0-9-]+)|\^\^<[^>]*>)?$')
+NT_LONG_ESCAPE = re.compile(r'\\U([0-9A-Fa-f]{8})')
+
+def open_dump(path):
+    """Open a dump as text, decompressing .gz and .bz2 files."""
+    if path.endswith(".gz"):
+        return gzip.open(path, "rt", encoding="utf-8")
+    if path.endswith(".bz2"):
+        return bz2.open(path, "rt", encoding="utf-8")
+    return open(path, "r", encoding="utf-8")
+
+def wikidata_time(value):
+    """
+    A Wikidata time value as the query service returns it: "+1750-00-00T00:00:00Z" becomes
+    "1750-01-01T00:00:00Z" (year and month precision dates start on the first day).
+    """
+    sign = "-" if value.startswith("-") else ""
+    date, _, time = value.lstrip("+-").partition("T")
+    parts = date.split("-")
+    parts[1:] = [part if part.strip("0") else "01" for part in parts[1:]]
+    return f"{sign}{'-'.join(parts)}T{time or '00:00:00Z'}"
+
+def truthy(statements):
+    """The statements the truthy (wdt:) triples hold: the preferred ones, or else the normal ones."""
+    preferred = [s for s in statements if s.get("rank") == "preferred"]
+    return preferred or [s for s in statements if s.get("rank", "normal") == "normal"]
+
+def json_entity_rows(entity):
+    """(qid, labels, claims, is_human) of one entity of a Wikidata JSON dump."""
+    qid = entity.get("id", "")
+    label = entity.get("labels", {}).get("en", {}).get("value")
+    labels = [(qid, label)] if label else []
+    claims = []
+    is_human = False
+    for prop in ("P31",) + PROPERTIES:
+        for statement in truthy(entity.get("claims", {}).get(prop, [])):
+            snak = statement.get("mainsnak", {})
+            if snak.get("snaktype", "value") != "value" or "datavalue" not in snak:
+                continue
+            value = snak["datavalue"]["value"]
+            if prop == "P31":
+                is_human = is_human or value.get("id") == HUMAN
+            elif prop in ITEM_PROPERTIES:
+                claims.append((qid, prop, value.get("id")))
+            else:
+                claims.append((qid, prop, wikidata_time(value["time"])))
+    return qid, labels, claims, is_human
+
+def read_json_dump(f):
+    """Entities of a Wikidata JSON dump: a JSON array with one entity per line."""
+    for line in f:
+        line = line.strip().rstrip(",")
+        if line and line not in ("[", "]"):
+            yield json.loads(line)
+
+def nt_literal(term):
+    """(value, language) of an N-Triples literal, or None for an IRI or blank node."""
+    match = NT_LITERAL.match(term)
+    if not match:
+        return None
+    body = NT_LONG_ESCAPE.sub(lambda m: chr(int(m.group(1), 16)), match.group(1))
+    return json.loads(f'"{body}"'), match.group(2)
+
+def nt_rows(line):
+    """(qid, labels, claims, is_human) of one line of a (truthy) Wikidata N-Triples dump."""
+    match = NT_LINE.match(line)
+    if not match or not match.group(1).startswith(WIKIDATA_ENTITY):
+        return None, [], [], False
+    subject, predicate, term = match.groups()
+    qid = subject[len(WIKIDATA_ENTITY):]
+    if predicate in LABEL_PREDICATES:
+        literal = nt_literal(term)
+        if literal and literal[1] == "en":
+            return qid, [(qid, literal[0])], [], False
+        return qid, [], [], False
+    if not predicate.startswith(WIKIDATA_PROP):
+        return qid, [], [], False
+    prop = predicate[len(WIKIDATA_PROP):]
+    if prop == "P31":
+        return qid, [], [], term == f"<{WIKIDATA_ENTITY}{HUMAN}>"
+    if prop in ITEM_PROPERTIES and term.startswith(f"<{WIKIDATA_ENTITY}"):
+        return qid, [], [(qid, prop, term[len(WIKIDATA_ENTITY) + 1:-1])], False
+    if prop in PROPERTIES:
+        literal = nt_literal(term)
+        if literal:
+            return qid, [], [(qid, prop, wikidata_time(literal[0]))], False
+    return qid, [], [], False
+
+def build_index(dump_path, index_path):
+    """
+    Build an offline index of the humans in a Wikidata dump subset into the SQLite file index_path.
+    The dump is a JSON dump (one entity per line) or truthy N-Triples, optionally .gz or .bz2, and
+    should hold the humans (P31 Q5) with their English labels, family names (P734), birth and death
+    dates (P569/P570) and occupations (P106), plus the family name and occupation items for their labels.
+    Only humans, their claims and the labels of the humans and the items they refer to are kept.
+    Returns the number of humans indexed.
+    """
+    if os.path.exists(index_path):
+        os.remove(index_path)
+    connection = sqlite3.connect(index_path)
+    connection.execute("CREATE TABLE humans (qid TEXT PRIMARY KEY)")
+    connection.execute("CREATE TABLE all_labels (qid TEXT PRIMARY KEY, label TEXT NOT NULL)")
+    connection.execute("CREATE TABLE all_claims (qid TEXT NOT NULL, prop TEXT NOT NULL, value TEXT NOT NULL)")
+
+    is_json = ".json" in os.path.basename(dump_path)
+    with open_dump(dump_path) as f:
+        rows = map(json_entity_rows, read_json_dump(f)) if is_json else map(nt_rows, f)
+        for batch in chunked(rows, INSERT_BATCH):
+            with connection:
+                for qid, labels, claims, is_human in batch:
+                    connection.executemany("INSERT OR IGNORE INTO all_labels VALUES (?, ?)", labels)
+                    connection.executemany("INSERT INTO all_claims VALUES (?, ?, ?)", claims)
+                    if is_human:
+                        connection.execute("INSERT OR IGNORE INTO humans VALUES (?)", (qid,))
+    with connection:
+        connection.execute("CREATE TABLE claims AS SELECT DISTINCT qid, prop, value FROM all_claims "
+                           "WHERE qid IN (SELECT qid FROM humans)")
+        connection.execute("CREATE TABLE labels AS SELECT qid, label FROM all_labels "
+                           "WHERE qid IN (SELECT qid FROM humans) OR qid IN (SELECT value FROM claims "
+                           f"WHERE prop IN ({', '.join('?' for _ in ITEM_PROPERTIES)}))", ITEM_PROPERTIES)
+        connection.execute("DROP TABLE all_labels")
+        connection.execute("DROP TABLE all_claims")
+        connection.execute("CREATE INDEX labels_label ON labels (label)")
+        connection.execute("CREATE UNIQUE INDEX labels_qid ON labels (qid)")
+        connection.execute("CREATE INDEX claims_qid ON claims (qid)")
+        connection.execute("CREATE INDEX claims_value ON claims (prop, value)")
+    count = connection.execute("SELECT COUNT(*) FROM humans").fetchone()[0]
+    connection.execute("VACUUM")
+    connection.close()
+    return count
+
+class WikidataIndex:
+    """
+    Offline replacement for the label and family-name queries of person_enrichment, backed by an
+    index built with build_index. Lookups match English labels exactly, as the VALUES queries do,
+    and return bindings of the same shape (person, personLabel, birthDate, deathDate, occupationLabel):
+    one per combination of birth date, death date and occupation of every matching human.
+    The SQLite connection is shared between threads behind a lock.
+    """
+
+    def __init__(self, index_path):
+        self.index_path = index_path
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(f"file:{index_path}?mode=ro", uri=True, check_same_thread=False)
+
+    def label(self, name):
+        """Bindings of the humans whose English label is name."""
+        with self.lock:
+            qids = [row[0] for row in self.connection.execute(
+                "SELECT l.qid FROM labels l JOIN humans h ON h.qid = l.qid WHERE l.label = ?", (name,))]
+        return self.bindings(qids)
+
+    def family_name(self, name):
+        """Bindings of the humans whose family name (P734) has name as English label."""
+        with self.lock:
+            qids = [row[0] for row in self.connection.execute(
+                "SELECT DISTINCT c.qid FROM labels l JOIN claims c ON c.prop = 'P734' AND c.value = l.qid "
+                "WHERE l.label = ?", (name,))]
+        return self.bindings(qids)
+
+    def lookup(self, variant, name):
+        """Bindings for a person_enrichment query variant ("label" or "family_name")."""
+        return self.label(name) if variant == "label" else self.family_name(name)
+
+    def bindings(self, qids):
+        results = []
+        for qid in sorted(qids, key=lambda qid: int(qid[1:]) if qid[1:].isdigit() else 0):
+            with self.lock:
+                label = self.connection.execute("SELECT label FROM labels WHERE qid = ?", (qid,)).fetchone()
+                claims = self.connection.execute(
+                    "SELECT c.prop, c.value, l.label FROM claims c LEFT JOIN labels l ON l.qid = c.value "
+                    "WHERE c.qid = ? ORDER BY c.rowid", (qid,)).fetchall()
+            values = {prop: [] for prop in PROPERTIES}
+            for prop, value, value_label in claims:
+                values[prop].append(value_label or value if prop in ITEM_PROPERTIES else value)
+            person = {
+                "person": {"type": "uri", "value": f"{WIKIDATA_ENTITY}{qid}"},
+                "personLabel": {"type": "literal", "value": label[0] if label else qid, "xml:lang": "en"},
+            }
+            for birth, death, occupation in itertools.product(values["P569"] or [None], values["P570"] or [None],
+                                                              values["P106"] or [None]):
+                binding = dict(person)
+                if birth:
+                    binding["birthDate"] = {"type": "literal", "value": birth, "datatype": XSD_DATE_TIME}
+                if death:
+                    binding["deathDate"] = {"type": "literal", "value": death, "datatype": XSD_DATE_TIME}
+                if occupation:
+                    binding["occupationLabel"] = {"type": "literal", "value": occupation, "xml:lang": "en"}
+                results.append(binding)
+        return results
+
+    def close(self):
+        self.connection.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Build an offline Wikidata index of humans from a Wikidata dump subset.")
+    parser.add_argument("dump_path", help="Filtered Wikidata dump: JSON (one entity per line) or truthy N-Triples, optionally .gz/.bz2.")
+    parser.add_argument("index_path", help="SQLite file to write the index to, e.g. wikidata_index.sqlite.")
+    args = parser.parse_args()
+
+    if not os.path.exists(args.dump_path):
+        parser.error(f"{args.dump_path} does not exist")
+    count = build_index(args.dump_path, args.index_path)
+    print(f"Indexed {count} Wikidata humans into {args.index_path}.")